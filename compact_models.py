@@ -0,0 +1,337 @@
+"""Shrink a trained Random Forest and report what each reduction costs.
+
+Variants are comma-separated steps applied to the pickled model:
+
+* ``select=K``: keep K trees, added greedily by how much each one improves
+  the sub-forest's training accuracy,
+* ``depth=D``: cut every tree at depth D,
+* ``quantize``: snap thresholds to the sensors' reporting resolution and
+  drop splits made unreachable by their ancestors,
+* ``distill-rf=N:D`` / ``distill-gbm=N:D``: fit a smaller forest or a
+  gradient-boosted model to the original model's predictions.
+
+Every rewritten tree also merges sibling leaves that vote for the same class.
+Each variant is scored on the same held-out split that train_models.py
+uses, with accuracy, agreement with the original, latency and pickle bytes.
+
+By default the server model is compacted, and its flash column is only a
+proxy: that forest reads 11 scaled features and never runs on the device.
+With ``--embedded`` the tool instead refits the forest train_models.py
+exports for the firmware (raw ``FIRMWARE_INPUTS``, same split and seed),
+compacts that, and measures the flash of the header each variant would
+generate. Its accuracy and agreement are then scored the way that header
+predicts, by one vote per tree, rather than with ``predict``.
+
+Example::
+
+    python3 compact_models.py air
+    python3 compact_models.py fire --data smoke_detection_iot.csv --variant select=20,depth=8,quantize
+    python3 compact_models.py air --save model/compact/best_model.pkl
+    python3 compact_models.py fire --embedded --save fire_model.h
+"""
+
+import argparse
+import copy
+import csv
+import math
+import os
+import sys
+
+import joblib
+import numpy as np
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+from sklearn.metrics import accuracy_score
+from sklearn.preprocessing import FunctionTransformer
+from sklearn.tree._tree import TREE_LEAF, TREE_UNDEFINED, Tree
+
+from train_models import (
+    FIRMWARE_INPUTS, FLASH_BYTES_PER_LEAF, FLASH_BYTES_PER_SPLIT, MODELS, export_header,
+    firmware_predict, fit_forest, flash_bytes, load_dataset, measure_latency, parse_depth, pickle_bytes,
+    split_dataset,
+)
+
+# Resolution each input reaches the API at: BME680 values in tenths, ENS160 and
+# PMS5003 values as integers, and the derived category/time features as integers.
+RESOLUTION = {
+    "co2": 1, "pm2_5": 1, "pm10": 1, "temperature": 0.1, "humidity": 0.1,
+    "co2_category": 1, "pm2_5_category": 1, "pm10_category": 1,
+    "hour": 1, "day_of_week": 1, "is_weekend": 1,
+    "Temperature[C]": 0.1, "Humidity[%]": 0.1, "TVOC[ppb]": 1, "eCO2[ppm]": 1,
+    "Raw H2": 1, "Raw Ethanol": 1, "Pressure[hPa]": 0.1,
+    "PM1.0": 1, "PM2.5": 1, "NC0.5": 1, "NC1.0": 1, "NC2.5": 1,
+}
+
+DEFAULT_VARIANTS = [
+    "original", "merge", "quantize", "depth=8", "depth=6", "select=25", "select=10",
+    "select=25,depth=8,quantize", "select=10,depth=6,quantize",
+    "distill-rf=10:6", "distill-gbm=50:3",
+]
+
+
+def threshold_quantizers(features, scaler=None):
+    """Map each feature index to a function snapping a threshold onto the sensor grid.
+
+    A threshold t becomes the midpoint between the grid values either side of
+    it, so every on-grid reading takes the same branch as before. Thresholds
+    are in scaled units when ``scaler`` is given, raw readings otherwise.
+    """
+    quantizers = {}
+    for i, name in enumerate(features):
+        res = RESOLUTION.get(name)
+        if res is None:
+            continue
+        mean, scale = (scaler.mean_[i], scaler.scale_[i]) if scaler is not None else (0.0, 1.0)
+
+        def snap(t, res=res, mean=mean, scale=scale):
+            raw = t * scale + mean
+            return ((math.floor(raw / res + 1e-9) + 0.5) * res - mean) / scale
+        quantizers[i] = snap
+    return quantizers
+
+
+def rewrite_tree(estimator, max_depth=None, quantizers=None):
+    """Return a copy of a fitted tree, cut at ``max_depth`` with thresholds snapped and redundant nodes removed."""
+    state = estimator.tree_.__getstate__()
+    old_nodes, old_values = state["nodes"], state["values"]
+    nodes, values = [], []
+
+    def make_leaf(index, value):
+        node = nodes[index]
+        node["left_child"] = node["right_child"] = TREE_LEAF
+        node["feature"] = TREE_UNDEFINED
+        node["threshold"] = TREE_UNDEFINED
+        values[index] = value
+
+    def is_leaf(index):
+        return nodes[index]["left_child"] == TREE_LEAF
+
+    def build(old, depth, bounds):
+        index = len(nodes)
+        nodes.append(old_nodes[old].copy())
+        values.append(old_values[old].copy())
+        if old_nodes[old]["left_child"] == TREE_LEAF or depth == max_depth:
+            make_leaf(index, values[index])
+            return index
+        feature = int(old_nodes[old]["feature"])
+        threshold = float(old_nodes[old]["threshold"])
+        if quantizers and feature in quantizers:
+            threshold = quantizers[feature](threshold)
+        low, high = bounds.get(feature, (-math.inf, math.inf))
+        if threshold >= high or threshold <= low:
+            # Ancestors already decide this split; splice in the only reachable child.
+            nodes.pop()
+            values.pop()
+            child = old_nodes[old]["left_child"] if threshold >= high else old_nodes[old]["right_child"]
+            return build(child, depth, bounds)
+        nodes[index]["threshold"] = threshold
+        left = build(old_nodes[old]["left_child"], depth + 1, {**bounds, feature: (low, min(high, threshold))})
+        right = build(old_nodes[old]["right_child"], depth + 1, {**bounds, feature: (max(low, threshold), high)})
+        if is_leaf(left) and is_leaf(right) and values[left].argmax() == values[right].argmax():
+            merged = values[left] + values[right]
+            del nodes[index + 1:], values[index + 1:]
+            make_leaf(index, merged)
+            return index
+        nodes[index]["left_child"] = left
+        nodes[index]["right_child"] = right
+        return index
+
+    build(0, 0, {})
+    depths = [0] * len(nodes)
+    for i, node in enumerate(nodes):
+        if node["left_child"] != TREE_LEAF:
+            depths[node["left_child"]] = depths[node["right_child"]] = depths[i] + 1
+    tree = estimator.tree_
+    rewritten = Tree(tree.n_features, np.asarray(tree.n_classes, dtype=np.intp), tree.n_outputs)
+    rewritten.__setstate__({
+        "max_depth": max(depths),
+        "node_count": len(nodes),
+        "nodes": np.array(nodes, dtype=old_nodes.dtype),
+        "values": np.ascontiguousarray(values, dtype=old_values.dtype),
+    })
+    result = copy.copy(estimator)
+    result.tree_ = rewritten
+    return result
+
+
+def select_trees(forest, X, y, k):
+    """Greedily pick ``k`` trees, each time adding the one that most raises the sub-forest's accuracy."""
+    probas = np.array([e.predict_proba(X) for e in forest.estimators_])
+    target = np.searchsorted(forest.classes_, y)
+    total = np.zeros(probas.shape[1:])
+    remaining = list(range(len(probas)))
+    chosen = []
+    for _ in range(min(k, len(remaining))):
+        accuracy = ((total + probas[remaining]).argmax(axis=2) == target).mean(axis=1)
+        best = remaining.pop(int(accuracy.argmax()))
+        chosen.append(best)
+        total += probas[best]
+    return [forest.estimators_[i] for i in chosen]
+
+
+def distill(teacher, X, kind, n_estimators, max_depth, random_state):
+    """Fit a smaller student to the teacher's labels on the training rows plus jittered copies."""
+    rng = np.random.default_rng(random_state)
+    rows = X[rng.integers(0, len(X), 4 * len(X))]
+    jittered = rows + rng.normal(0.0, 0.05, rows.shape) * X.std(axis=0)
+    X_distill = np.vstack([X, jittered])
+    if kind == "rf":
+        student = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=random_state)
+    else:
+        student = GradientBoostingClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=random_state)
+    return student.fit(X_distill, teacher.predict(X_distill))
+
+
+def build_variant(name, forest, X_train, y_train, quantizers, random_state):
+    if name == "original":
+        return forest
+    steps = dict(step.partition("=")[::2] for step in name.split(","))
+    for kind in ("rf", "gbm"):
+        if "distill-" + kind in steps:
+            n_estimators, _, max_depth = steps["distill-" + kind].partition(":")
+            return distill(forest, X_train, kind, int(n_estimators), int(max_depth) if max_depth else None, random_state)
+    unknown = set(steps) - {"merge", "select", "depth", "quantize"}
+    if unknown:
+        raise SystemExit("Unknown compaction step: %s" % ", ".join(sorted(unknown)))
+    estimators = forest.estimators_
+    if "select" in steps:
+        estimators = select_trees(forest, X_train, y_train, int(steps["select"]))
+    max_depth = int(steps["depth"]) if "depth" in steps else None
+    compact = copy.copy(forest)
+    compact.estimators_ = [rewrite_tree(e, max_depth, quantizers if "quantize" in steps else None)
+                           for e in estimators]
+    compact.n_estimators = len(compact.estimators_)
+    return compact
+
+
+def tree_counts(model):
+    trees = [e.tree_ for e in np.ravel(model.estimators_)]
+    splits = sum(int((t.children_left != TREE_LEAF).sum()) for t in trees)
+    return len(trees), splits, sum(t.node_count for t in trees) - splits
+
+
+def predict_as_deployed(model, scaler, X, embedded, class_map):
+    """Predictions as the deployed artifact makes them: the header's hard vote for firmware forests."""
+    if embedded and isinstance(model, RandomForestClassifier):
+        return firmware_predict(model, X, class_map)
+    predicted = model.predict(scaler.transform(X))
+    return np.array([class_map[int(c)] for c in predicted]) if embedded else predicted
+
+
+def model_flash_bytes(model, inputs, class_map=None):
+    """Flash bytes of the header ``model`` would export; an estimate for models export_header cannot render."""
+    if isinstance(model, RandomForestClassifier):
+        return flash_bytes(model, inputs, class_map)[0]
+    _, splits, leaves = tree_counts(model)
+    return splits * FLASH_BYTES_PER_SPLIT + leaves * FLASH_BYTES_PER_LEAF
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact a trained model and report accuracy vs latency vs bytes.")
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument("--data", help="dataset CSV (default: the model's dataset)")
+    parser.add_argument("--model-file", help="pickled forest (default: model/<model file>)")
+    parser.add_argument("--scaler-file", help="pickled scaler (default: model/<scaler file>)")
+    parser.add_argument("--embedded", action="store_true",
+                        help="compact the firmware forest instead of the server model")
+    parser.add_argument("--estimators", type=int, default=100, help="firmware forest size, as in train_models.py")
+    parser.add_argument("--max-depth", type=parse_depth, default=None,
+                        help="firmware forest depth, as in train_models.py")
+    parser.add_argument("--class-weight", choices=["balanced"], default=None)
+    parser.add_argument("--train-size", type=float, default=0.8)
+    parser.add_argument("--random-state", type=int, default=42)
+    parser.add_argument("--variant", action="append", help="compaction steps, repeatable (default: a standard set)")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="accuracy loss accepted when picking the variant to save")
+    parser.add_argument("--latency-repeats", type=int, default=200)
+    parser.add_argument("--report", help="write the report as CSV")
+    parser.add_argument("--save", help="save the smallest variant within --tolerance of the original here "
+                                       "(a pickle, or a firmware header with --embedded)")
+    args = parser.parse_args()
+
+    spec = MODELS[args.model]
+    data_path = args.data or spec["data"]
+    if not os.path.exists(data_path):
+        raise SystemExit("Dataset not found: %s (pass --data)" % data_path)
+    df = load_dataset(spec, data_path)
+    X_train, X_test, y_train, y_test = split_dataset(spec, df, args.train_size, args.random_state)
+    if args.embedded:
+        # The firmware forest is trained unscaled on the raw sensor inputs it reads.
+        columns = [c for c in spec["firmware_columns"].values() if c is not None]
+        inputs = [FIRMWARE_INPUTS.index(name) for name, c in spec["firmware_columns"].items() if c is not None]
+        class_map = spec["firmware_classes"]
+        X_train, X_test = X_train[columns], X_test[columns]
+        forest = fit_forest(X_train.to_numpy(), y_train, args.estimators, args.max_depth, args)
+        # Identity "scaler" that hands the forest plain arrays, as it was fitted on.
+        scaler = FunctionTransformer(validate=True).fit(X_train)
+        quantizers = threshold_quantizers(columns)
+        flash_column = "flash_bytes"
+    else:
+        forest = joblib.load(args.model_file or os.path.join("model", spec["model_file"]))
+        scaler = joblib.load(args.scaler_file or os.path.join("model", spec["scaler_file"]))
+        inputs, class_map = list(range(forest.n_features_in_)), None
+        X_train, X_test = X_train[spec["features"]], X_test[spec["features"]]
+        quantizers = threshold_quantizers(spec["features"], scaler)
+        # The server forest never runs on the device; its compiled size only hints at the firmware's.
+        flash_column = "server_flash_proxy"
+    X_scaled = scaler.transform(X_train)
+    reference = predict_as_deployed(forest, scaler, X_test, args.embedded, class_map)
+    y_deployed = np.array([class_map[int(c)] for c in y_test]) if args.embedded else y_test.to_numpy()
+
+    print("Compacting %s %s model on %d held-out rows"
+          % (args.model, "firmware" if args.embedded else "server", len(X_test)))
+    print("%-28s %5s %7s %8s %8s %10s %9s %9s" % (
+        "variant", "trees", "nodes", "accuracy", "agree", "latency_us", "pickle",
+        "flash" if args.embedded else "flash~"))
+    rows = []
+    models = {}
+    for name in args.variant or DEFAULT_VARIANTS:
+        model = build_variant(name, forest, X_scaled, y_train.to_numpy(), quantizers, args.random_state)
+        trees, splits, leaves = tree_counts(model)
+        latency_us, _ = measure_latency(model, scaler, X_test, args.latency_repeats)
+        predicted = predict_as_deployed(model, scaler, X_test, args.embedded, class_map)
+        row = {
+            "variant": name,
+            "trees": trees,
+            "nodes": splits + leaves,
+            "accuracy": round(float(accuracy_score(y_deployed, predicted)), 4),
+            "agreement": round(float(accuracy_score(reference, predicted)), 4),
+            "latency_us": round(latency_us, 1),
+            "pickle_bytes": pickle_bytes(model),
+            flash_column: model_flash_bytes(model, inputs, class_map),
+        }
+        rows.append(row)
+        models[name] = model
+        print("%(variant)-28s %(trees)5d %(nodes)7d %(accuracy)8.4f %(agreement)8.4f "
+              "%(latency_us)10.1f %(pickle_bytes)9d " % row + "%9d" % row[flash_column])
+
+    if args.report:
+        with open(args.report, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    baseline = float(accuracy_score(y_deployed, reference))
+    if args.embedded:
+        # Only forests can be rendered as a firmware header; pick by what they cost in flash.
+        candidates = [r for r in rows if isinstance(models[r["variant"]], RandomForestClassifier)]
+        size_column = flash_column
+    else:
+        candidates, size_column = rows, "pickle_bytes"
+    smallest = min((r for r in candidates if r["accuracy"] >= baseline - args.tolerance),
+                   key=lambda r: r[size_column])
+    print("Smallest variant within %.3f of the original accuracy: %s (%d %s)"
+          % (args.tolerance, smallest["variant"], smallest[size_column], size_column))
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        if args.embedded:
+            with open(args.save, "w") as f:
+                f.write(export_header(models[smallest["variant"]], inputs,
+                                      "compact_models.py %s" % smallest["variant"], class_map))
+        else:
+            joblib.dump(models[smallest["variant"]], args.save)
+        print("Saved to %s" % args.save)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+"""Export a pickled Random Forest and its scaler as flat arrays, and predict from them.
+
+The export is a directory of ``.npy`` files, one contiguous array each:
+
+* ``feature``, ``threshold``, ``left``, ``right``: every tree's nodes
+  concatenated, with child indices global to the file. Leaves keep
+  scikit-learn's negative feature and child markers,
+* ``value``: each leaf's class probabilities, already normalised the way
+  ``DecisionTreeClassifier.predict_proba`` does it,
+* ``roots``: the first node of each tree,
+* ``mean``, ``scale``: the ``StandardScaler`` parameters,
+
+plus ``meta.json`` with the feature order, classes, depth and the hashes of
+the pickles it came from. ``FlatForest.load`` memory-maps the arrays, so
+processes loading the same export share one copy through the page cache and
+never import scikit-learn. ``predict_proba`` walks all trees for all rows
+at once in NumPy and returns the same bits as scaling with the scaler and
+calling the forest's ``predict_proba``.
+
+Run as a script, it exports one model, checks it bit for bit against the
+pickles on the model's dataset and compares worker start-up cost.
+
+Example::
+
+    python3 flat_forest.py air
+    python3 flat_forest.py fire --data smoke_detection_iot.csv
+    python3 flat_forest.py air --model-file model/versions/<version>/best_model.pkl --output /tmp/air.flat
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ARRAYS = ("feature", "threshold", "left", "right", "value", "roots", "mean", "scale")
+
+
+def flat_dir(model_path):
+    """Default export directory for a pickled model: ``model/best_model.pkl`` -> ``model/best_model.flat``."""
+    return os.path.splitext(model_path)[0] + ".flat"
+
+
+def export(model, scaler, features, out_dir, sources=None):
+    """Write ``model`` and ``scaler`` to ``out_dir`` as flat arrays."""
+    if model.n_outputs_ != 1:
+        raise SystemExit("Only single-output forests can be exported")
+    feature, threshold, left, right, value, roots = [], [], [], [], [], []
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        leaf = tree.children_left == -1
+        # Same arithmetic as DecisionTreeClassifier.predict_proba, done once per leaf.
+        proba = tree.value[:, 0, :model.n_classes_].copy()
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba /= normalizer
+        roots.append(offset)
+        feature.append(tree.feature)
+        threshold.append(tree.threshold)
+        left.append(np.where(leaf, -1, tree.children_left + offset))
+        right.append(np.where(leaf, -1, tree.children_right + offset))
+        value.append(proba)
+        offset += tree.node_count
+    if offset > np.iinfo(np.int32).max:
+        raise SystemExit("Forest has too many nodes for 32-bit indices")
+    arrays = {
+        "feature": np.concatenate(feature).astype(np.int32),
+        "threshold": np.concatenate(threshold).astype(np.float64),
+        "left": np.concatenate(left).astype(np.int32),
+        "right": np.concatenate(right).astype(np.int32),
+        "value": np.concatenate(value).astype(np.float64),
+        "roots": np.array(roots, dtype=np.int32),
+        "mean": np.asarray(scaler.mean_, dtype=np.float64),
+        "scale": np.asarray(scaler.scale_, dtype=np.float64),
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, name + ".npy"), np.ascontiguousarray(array))
+    meta = {
+        "features": list(features),
+        "classes": [int(c) for c in model.classes_],
+        "n_estimators": len(model.estimators_),
+        "max_depth": max(e.tree_.max_depth for e in model.estimators_),
+        "nodes": offset,
+        "sources": sources or {},
+    }
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def read_meta(path):
+    with open(os.path.join(path, "meta.json")) as f:
+        return json.load(f)
+
+
+def ensure_export(model_path, scaler_path, features, out_dir=None):
+    """Export the pickles to ``out_dir`` unless an export of the same files is already there; return the path."""
+    from train_models import sha256_file
+
+    out_dir = out_dir or flat_dir(model_path)
+    sources = {path: sha256_file(path) for path in (model_path, scaler_path)}
+    if os.path.exists(os.path.join(out_dir, "meta.json")):
+        meta = read_meta(out_dir)
+        if sorted(meta["sources"].values()) == sorted(sources.values()) and meta["features"] == list(features):
+            return out_dir
+    import joblib
+
+    export(joblib.load(model_path), joblib.load(scaler_path), features, out_dir, sources)
+    return out_dir
+
+
+class FlatForest:
+    """Scaler plus Random Forest evaluated from a flat, memory-mapped export."""
+
+    def __init__(self, path, mmap_mode="r"):
+        self.meta = read_meta(path)
+        for name in ARRAYS:
+            # Plain ndarray views of the mapping index faster than np.memmap objects.
+            setattr(self, name, np.asarray(np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)))
+        self.features = self.meta["features"]
+        self.classes_ = np.array(self.meta["classes"])
+
+    @classmethod
+    def load(cls, path):
+        return cls(path)
+
+    def apply(self, X):
+        """Global leaf index each tree reaches for each row of already scaled ``X``, shape (trees, rows)."""
+        # The forest compares float32 inputs against float64 thresholds.
+        X = np.asarray(X, dtype=np.float32)
+        n_rows, n_features = X.shape
+        values = X.ravel()
+        nodes = np.repeat(np.asarray(self.roots), n_rows)
+        offsets = np.tile(np.arange(n_rows) * n_features, len(self.roots))
+        # Walk only the (tree, row) pairs still at a split; each step moves all of them one level down.
+        active = np.flatnonzero(self.feature[nodes] >= 0)
+        while active.size:
+            current = nodes[active]
+            go_left = values[offsets[active] + self.feature[current]] <= self.threshold[current]
+            current = np.where(go_left, self.left[current], self.right[current])
+            nodes[active] = current
+            active = active[self.feature[current] >= 0]
+        return nodes.reshape(len(self.roots), n_rows)
+
+    def transform(self, X):
+        """Scale raw inputs, given in ``features`` order, as ``StandardScaler.transform`` does."""
+        return (np.asarray(X, dtype=np.float64) - self.mean) / self.scale
+
+    def predict_proba(self, X):
+        """Class probabilities for raw inputs in ``features`` order, in ``classes_`` order."""
+        leaves = self.apply(self.transform(X))
+        # Sum the trees one at a time, in order, as the forest does before averaging.
+        proba = np.zeros((leaves.shape[1], len(self.classes_)), dtype=np.float64)
+        for tree_leaves in leaves:
+            proba += self.value[tree_leaves]
+        proba /= self.meta["n_estimators"]
+        return proba
+
+    def predict(self, X):
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+
+def startup_cost(code):
+    """Run ``code`` in a fresh interpreter and return (seconds, peak RSS in MB) for it."""
+    # VmHWM starts over at exec, unlike ru_maxrss, which a child inherits from this process.
+    probe = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "%s\n"
+        "elapsed = time.perf_counter() - start\n"
+        "hwm = [l for l in open('/proc/self/status') if l.startswith('VmHWM')][0].split()[1]\n"
+        "print(elapsed, hwm)\n" % code
+    )
+    out = subprocess.run([sys.executable, "-c", probe], check=True, capture_output=True, text=True)
+    seconds, rss_kb = out.stdout.split()[-2:]
+    return float(seconds), int(rss_kb) / 1024
+
+
+def main():
+    from train_models import MODELS, load_dataset, measure_latency, sha256_file
+
+    parser = argparse.ArgumentParser(description="Export a model as flat arrays and check it against the pickles.")
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument("--data", help="dataset CSV to check against (default: the model's dataset)")
+    parser.add_argument("--model-file", help="pickled forest (default: model/<model file>)")
+    parser.add_argument("--scaler-file", help="pickled scaler (default: next to the model file)")
+    parser.add_argument("--output", help="export directory (default: the model file with .flat)")
+    parser.add_argument("--latency-repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    import joblib
+
+    spec = MODELS[args.model]
+    model_path = args.model_file or os.path.join("model", spec["model_file"])
+    scaler_path = args.scaler_file or os.path.join(os.path.dirname(model_path), spec["scaler_file"])
+    out_dir = args.output or flat_dir(model_path)
+    model, scaler = joblib.load(model_path), joblib.load(scaler_path)
+    sources = {path: sha256_file(path) for path in (model_path, scaler_path)}
+    meta = export(model, scaler, spec["features"], out_dir, sources)
+    print("Exported %d trees, %d nodes, depth %d to %s"
+          % (meta["n_estimators"], meta["nodes"], meta["max_depth"], out_dir))
+
+    data_path = args.data or spec["data"]
+    if not os.path.exists(data_path):
+        print("Dataset not found: %s, skipping the check (pass --data)" % data_path)
+        return 0
+    X = load_dataset(spec, data_path)[spec["features"]]
+    expected = model.predict_proba(scaler.transform(X))
+    flat = FlatForest.load(out_dir)
+    raw = X.to_numpy(dtype=float)
+    actual = flat.predict_proba(raw)
+    mismatched = int((actual.view(np.uint64) != expected.view(np.uint64)).any(axis=1).sum())
+    print("predict_proba on %d rows of %s: %d differ in any bit" % (len(X), data_path, mismatched))
+
+    samples = []
+    for _ in range(args.latency_repeats):
+        start = time.perf_counter()
+        flat.predict_proba(raw[:1])
+        samples.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    flat.predict_proba(raw)
+    flat_batch = (time.perf_counter() - start) / len(raw)
+    single_us, batch_us = measure_latency(model, scaler, X, args.latency_repeats)
+    print("Single request: %.1f us flat, %.1f us sklearn; batch: %.2f us/row flat, %.2f us/row sklearn"
+          % (np.median(samples) * 1e6, single_us, flat_batch * 1e6, batch_us))
+
+    pickled = startup_cost("import joblib; joblib.load(%r); joblib.load(%r)" % (model_path, scaler_path))
+    mapped = startup_cost("sys.path.insert(0, %r); import flat_forest; flat_forest.FlatForest.load(%r)"
+                          % (os.path.dirname(os.path.abspath(__file__)), out_dir))
+    print("Worker start-up: %.0f ms / %.0f MB RSS unpickling, %.0f ms / %.0f MB RSS memory-mapped"
+          % (pickled[0] * 1e3, pickled[1], mapped[0] * 1e3, mapped[1]))
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,6 +2,7 @@
 #include "LCDi2c.h"
 #include <stdio.h>
 #include <cstring>
+#include <stdlib.h>
 
 namespace FireModelNamespace {
     #include "fire_model.h"
@@ -17,7 +18,7 @@ LCDi2c lcd(PTE25, PTE24, LCD20x4, 0x27);
 DigitalOut led(LED1);
 DigitalOut buzzer(PTB9);
 InterruptIn button(PTC3);
-BufferedSerial pms5003(D1, D0, 9600);
+UnbufferedSerial pms5003(D1, D0, 9600);
 BufferedSerial esp(PTD3, PTD2, 115200);
 
 volatile bool buttonPressed = false;
@@ -89,6 +90,43 @@ char fireStatus[20] = "";
 char zoneStatus[20] = "";
 int currentFirePrediction = 0;
 int currentZonePrediction = 0;
+#define UPLOAD_AIR  0x01
+#define UPLOAD_FIRE 0x02
+#define EDGE_CONFIDENT_STREAK 3
+#define EDGE_MIN_MARGIN_PCT 40
+int fireStreak = 0;
+int zoneStreak = 0;
+int fireMargin = 100;
+int zoneMargin = 100;
+bool fireEscalate = false;
+bool zoneEscalate = false;
+uint8_t edgeClear = 0;
+uint32_t lastAirLiveUpload = 0;
+uint32_t lastFireLiveUpload = 0;
+// Vote margin (percent of trees between the top two classes) from headers generated
+// by train_models.py; older Eloquent headers have no margin() and count as decisive,
+// leaving prediction stability as the only uncertainty signal.
+template <typename Model> auto model_margin(Model& model, int) -> decltype(model.margin()) {
+    return model.margin();
+}
+template <typename Model> int model_margin(Model&, long) {
+    return 100;
+}
+#define TREND_ALPHA 0.6f
+#define TREND_BETA 0.6f
+#define TEMP_RISE_PER_MIN 1.0f
+#define TVOC_RISE_PER_MIN 200.0f
+#define PM25_RISE_PER_MIN 20.0f
+struct Trend {
+    float level;
+    float slope;
+    int samples;
+};
+Trend tempTrend = {0};
+Trend tvocTrend = {0};
+Trend pm25Trend = {0};
+float lastTrendUpdate = 0.0f;
+bool riseAlert = false;
 
 char apiAirMessage[64] = "Not available";
 char apiFireMessage[64] = "Not available";
@@ -211,14 +249,87 @@ const char* getAQIDescription(uint8_t aqi) {
         default: return "Invalid";
     }
 }
-void clear_serial_buffer() {
-    uint8_t temp;
-    int flush_attempts = 5;
-    while (flush_attempts--) {
-        while (pms5003.readable()) {
-            pms5003.read(&temp, 1);
+#define PMS_RING_SIZE 256
+#define PMS_FRAME_SIZE 32
+volatile uint8_t pmsRing[PMS_RING_SIZE];
+volatile uint16_t pmsRingHead = 0;
+volatile uint16_t pmsRingTail = 0;
+volatile uint32_t pmsRingOverruns = 0;
+struct PmsParser {
+    uint8_t frame[PMS_FRAME_SIZE];
+    int pos;
+};
+PmsParser pmsParser;
+uint8_t pmsLatest[PMS_FRAME_SIZE];
+uint32_t pmsFrames = 0;
+uint32_t pmsFramesRead = 0;
+uint32_t pmsChecksumErrors = 0;
+uint32_t pmsOverrunsSeen = 0;
+void on_pms_rx() {
+    uint8_t c;
+    while (pms5003.readable()) {
+        pms5003.read(&c, 1);
+        pmsRing[pmsRingHead] = c;
+        pmsRingHead = (pmsRingHead + 1) % PMS_RING_SIZE;
+        if (pmsRingHead == pmsRingTail) {
+            pmsRingTail = (pmsRingTail + 1) % PMS_RING_SIZE;
+            pmsRingOverruns++;
         }
-        ThisThread::sleep_for(100ms);
+    }
+}
+bool pms_feed(PmsParser* p, uint8_t c);
+void pms_resync(PmsParser* p, int from) {
+    uint8_t rest[PMS_FRAME_SIZE];
+    int n = p->pos - from;
+    memcpy(rest, p->frame + from, n);
+    p->pos = 0;
+    for (int i = 0; i < n; i++) {
+        pms_feed(p, rest[i]);
+    }
+}
+bool pms_feed(PmsParser* p, uint8_t c) {
+    if (p->pos == 0 && c != 0x42) return false;
+    if (p->pos == 1 && c != 0x4D) {
+        p->pos = (c == 0x42) ? 1 : 0;
+        return false;
+    }
+    p->frame[p->pos++] = c;
+    if (p->pos == 4 && ((p->frame[2] << 8) | p->frame[3]) != PMS_FRAME_SIZE - 4) {
+        pms_resync(p, 1);
+        return false;
+    }
+    if (p->pos < PMS_FRAME_SIZE) return false;
+    uint16_t checksum = 0;
+    for (int i = 0; i < PMS_FRAME_SIZE - 2; i++) {
+        checksum += p->frame[i];
+    }
+    uint16_t received_checksum = (p->frame[30] << 8) | p->frame[31];
+    if (checksum != received_checksum) {
+        pmsChecksumErrors++;
+        pms_resync(p, 1);
+        return false;
+    }
+    memcpy(pmsLatest, p->frame, PMS_FRAME_SIZE);
+    pmsFrames++;
+    p->pos = 0;
+    return true;
+}
+void pms_poll() {
+    uint8_t bytes[PMS_RING_SIZE];
+    int n = 0;
+    core_util_critical_section_enter();
+    while (pmsRingTail != pmsRingHead) {
+        bytes[n++] = pmsRing[pmsRingTail];
+        pmsRingTail = (pmsRingTail + 1) % PMS_RING_SIZE;
+    }
+    uint32_t overruns = pmsRingOverruns;
+    core_util_critical_section_exit();
+    if (overruns != pmsOverrunsSeen) {
+        pmsOverrunsSeen = overruns;
+        pmsParser.pos = 0;
+    }
+    for (int i = 0; i < n; i++) {
+        pms_feed(&pmsParser, bytes[i]);
     }
 }
 void wake_up_pms5003() {
@@ -234,61 +345,14 @@ void set_pms5003_active_mode() {
 bool initPMS5003() {
     wake_up_pms5003();
     set_pms5003_active_mode();
+    pms5003.attach(&on_pms_rx, SerialBase::RxIrq);
     return true;
 }
 bool read_pms5003() {
-    uint8_t buffer[32] = {0};
-    uint16_t checksum = 0;
-    clear_serial_buffer();
-    ThisThread::sleep_for(300ms);
-    int timeout = 3000;
-    bool start_found = false;
-    while (timeout > 0 && !start_found) {
-        if (pms5003.readable()) {
-            pms5003.read(&buffer[0], 1);
-            if (buffer[0] == 0x42) {
-                int wait_time = 0;
-                while (!pms5003.readable() && wait_time < 100) {
-                    ThisThread::sleep_for(5ms);
-                    wait_time += 5;
-                }
-                if (pms5003.readable()) {
-                    pms5003.read(&buffer[1], 1);
-                    if (buffer[1] == 0x4D) {
-                        start_found = true;
-                        break;
-                    }
-                }
-            }
-        }
-        ThisThread::sleep_for(10ms);
-        timeout -= 10;
-    }
-    if (!start_found) return false;
-    bool read_complete = true;
-    for (int i = 2; i < 32; i++) {
-        timeout = 500;
-        bool byte_read = false;
-        while (timeout > 0 && !byte_read) {
-            if (pms5003.readable()) {
-                pms5003.read(&buffer[i], 1);
-                byte_read = true;
-            } else {
-                ThisThread::sleep_for(5ms);
-                timeout -= 5;
-            }
-        }
-        if (!byte_read) {
-            read_complete = false;
-            break;
-        }
-    }
-    if (!read_complete) return false;
-    for (int i = 0; i < 30; i++) {
-        checksum += buffer[i];
-    }
-    uint16_t received_checksum = (buffer[30] << 8) | buffer[31];
-    if (checksum != received_checksum) return false;
+    pms_poll();
+    if (pmsFrames == pmsFramesRead) return false;
+    pmsFramesRead = pmsFrames;
+    const uint8_t* buffer = pmsLatest;
     pm1_0 = (buffer[4] << 8) | buffer[5];
     pm2_5 = (buffer[6] << 8) | buffer[7];
     pm10  = (buffer[8] << 8) | buffer[9];
@@ -299,9 +363,39 @@ bool read_pms5003() {
     particles_50um = (buffer[24] << 8) | buffer[25];
     particles_100um = (buffer[26] << 8) | buffer[27];
     reading_counter++;
+    printf("PMS5003: %lu frames, %lu checksum errors, %lu overruns\n", (unsigned long)pmsFrames, (unsigned long)pmsChecksumErrors, (unsigned long)pmsOverrunsSeen);
     return true;
 }
+void trend_update(Trend* t, float x, float minutes) {
+    if (t->samples == 0) {
+        t->level = x;
+        t->slope = 0.0f;
+    } else {
+        float level = TREND_ALPHA * x + (1.0f - TREND_ALPHA) * (t->level + t->slope * minutes);
+        t->slope = TREND_BETA * (level - t->level) / minutes + (1.0f - TREND_BETA) * t->slope;
+        t->level = level;
+    }
+    t->samples++;
+}
+bool trend_rising(const Trend* t, float per_minute) {
+    return t->samples >= 2 && t->slope >= per_minute;
+}
+void update_trends() {
+    float now = sensorReadTimer.elapsed_time().count() / 1000000.0f;
+    float minutes = (now - lastTrendUpdate) / 60.0f;
+    lastTrendUpdate = now;
+    trend_update(&tempTrend, temp_x10 / 10.0f, minutes);
+    trend_update(&tvocTrend, (float)tvoc, minutes);
+    trend_update(&pm25Trend, (float)pm2_5, minutes);
+    riseAlert = trend_rising(&tempTrend, TEMP_RISE_PER_MIN) ||
+                trend_rising(&tvocTrend, TVOC_RISE_PER_MIN) ||
+                trend_rising(&pm25Trend, PM25_RISE_PER_MIN);
+    printf("Rate of rise: temp %.2f C/min, TVOC %.0f ppb/min, PM2.5 %.1f ug/m3/min%s\n",
+        tempTrend.slope, tvocTrend.slope, pm25Trend.slope, riseAlert ? " (ALERT)" : "");
+}
 void makePredictions() {
+    bool wasRising = riseAlert;
+    update_trends();
     float sensorInput[6] = {
         ((float)temp_x10)/10.0f, 
         ((float)humidity_x10)/10.0f, 
@@ -314,10 +408,26 @@ void makePredictions() {
     ZoneModel localZoneModel;
     int firePrediction = localFireModel.predict(sensorInput);
     int zonePrediction = localZoneModel.predict(sensorInput);
+    fireMargin = model_margin(localFireModel, 0);
+    zoneMargin = model_margin(localZoneModel, 0);
+    fireStreak = (firePrediction == currentFirePrediction) ? fireStreak + 1 : 1;
+    zoneStreak = (zonePrediction == currentZonePrediction) ? zoneStreak + 1 : 1;
     currentFirePrediction = firePrediction;
     currentZonePrediction = zonePrediction;
+    // A class change or a new rise alert goes to the cloud at once. Anything else the
+    // edge is not sure about, or that is not clear, goes at most once per upload interval.
+    uint32_t now = sensorReadTimer.elapsed_time().count() / 1000000;
+    bool fireChanged = fireStreak == 1 || (riseAlert && !wasRising);
+    bool zoneChanged = zoneStreak == 1;
+    bool fireNeedsCloud = firePrediction != 0 || fireStreak < EDGE_CONFIDENT_STREAK ||
+                          fireMargin < EDGE_MIN_MARGIN_PCT || riseAlert;
+    bool zoneNeedsCloud = zonePrediction != 0 || zoneStreak < EDGE_CONFIDENT_STREAK ||
+                          zoneMargin < EDGE_MIN_MARGIN_PCT;
+    if (fireChanged || (fireNeedsCloud && now - lastFireLiveUpload >= api_update_interval)) fireEscalate = true;
+    if (zoneChanged || (zoneNeedsCloud && now - lastAirLiveUpload >= api_update_interval)) zoneEscalate = true;
+    edgeClear = (zoneNeedsCloud ? 0 : UPLOAD_AIR) | (fireNeedsCloud ? 0 : UPLOAD_FIRE);
     switch(firePrediction) {
-        case 0: strcpy(fireStatus, "No fire"); break;
+        case 0: strcpy(fireStatus, riseAlert ? "Rising" : "No fire"); break;
         case 1: strcpy(fireStatus, "Possible"); break;
         case 2: strcpy(fireStatus, "Fire!"); break;
         default: strcpy(fireStatus, "Unknown"); break;
@@ -335,9 +445,12 @@ void makePredictions() {
     } else {
         buzzerPattern = 0;
     }
+    if (riseAlert && buzzerPattern == 0) buzzerPattern = 1;
     printf("Fire prediction: %d (%s)\n", firePrediction, fireStatus);
     printf("Zone prediction: %d (%s)\n", zonePrediction, zoneStatus);
     printf("Buzzer pattern: %d\n", buzzerPattern);
+    printf("Edge confidence: fire %d/%d margin %d%%, zone %d/%d margin %d%%\n",
+        fireStreak, EDGE_CONFIDENT_STREAK, fireMargin, zoneStreak, EDGE_CONFIDENT_STREAK, zoneMargin);
 }
 void updateBuzzer() {
     int64_t currentTime = buzzerTimer.elapsed_time().count() / 1000;
@@ -367,7 +480,6 @@ void readAllSensors() {
 void send_esp(const char* cmd) {
     esp.write(cmd, strlen(cmd));
     esp.write("\r\n", 2);
-    ThisThread::sleep_for(300ms);
 }
 bool read_esp(int timeout = 3000, const char* success_text = "OK") {
     Timer t;
@@ -380,6 +492,7 @@ bool read_esp(int timeout = 3000, const char* success_text = "OK") {
             esp.read(&c, 1);
             if (pos < 511) {
                 buffer[pos++] = c;
+                if (strstr(buffer, success_text) || strstr(buffer, "ERROR") || strstr(buffer, "FAIL")) break;
             }
         }
     }
@@ -390,8 +503,7 @@ bool read_esp(int timeout = 3000, const char* success_text = "OK") {
 bool init_wifi(const char* ssid, const char* password) {
     printf("Initializing WiFi...\n");
     send_esp("AT+RST");
-    ThisThread::sleep_for(2000ms);
-    read_esp(5000);
+    read_esp(5000, "ready");
     send_esp("AT");
     if (!read_esp(2000, "OK")) {
         printf("ESP8266 not responding\n");
@@ -412,43 +524,268 @@ bool init_wifi(const char* ssid, const char* password) {
     printf("WiFi connected successfully\n");
     return true;
 }
-void check_wifi_connection() {
-    send_esp("AT");
-    if (!read_esp(2000, "OK")) {
-        send_esp("AT+CIPCLOSE");
-        ThisThread::sleep_for(1000ms);
-        send_esp("AT");
-        wifi_connected = read_esp(2000, "OK");
+const char* json_value(const char* json, const char* key) {
+    char pattern[32];
+    snprintf(pattern, sizeof(pattern), "\"%s\"", key);
+    const char* p = strstr(json, pattern);
+    if (p == NULL) return NULL;
+    p += strlen(pattern);
+    while (*p == ' ' || *p == ':') p++;
+    return p;
+}
+bool json_bool(const char* json, const char* key, bool* value) {
+    const char* p = json_value(json, key);
+    if (p == NULL) return false;
+    if (strncmp(p, "true", 4) == 0) {
+        *value = true;
+    } else if (strncmp(p, "false", 5) == 0) {
+        *value = false;
     } else {
-        wifi_connected = true;
+        return false;
     }
+    return true;
 }
-bool sendPost(const char* host, const char* path, const char* body) {
-    char cmd[128];
-    sprintf(cmd, "AT+CIPSTART=\"TCP\",\"%s\",80", host);
-    send_esp(cmd);
-    read_esp(5000, "CONNECT");
-    char req[1024];
-    sprintf(req,
-        "POST %s HTTP/1.1\r\n"
-        "Host: %s\r\n"
-        "Content-Type: application/json\r\n"
-        "Content-Length: %d\r\n\r\n"
-        "%s", path, host, strlen(body), body);
-    sprintf(cmd, "AT+CIPSEND=%d", strlen(req));
+bool json_float(const char* json, const char* key, float* value) {
+    const char* p = json_value(json, key);
+    if (p == NULL) return false;
+    char* end;
+    float v = strtof(p, &end);
+    if (end == p) return false;
+    *value = v;
+    return true;
+}
+bool json_string(const char* json, const char* key, char* value, size_t size) {
+    const char* p = json_value(json, key);
+    if (p == NULL || *p != '"') return false;
+    p++;
+    size_t n = 0;
+    while (p[n] && p[n] != '"' && n < size - 1) n++;
+    memcpy(value, p, n);
+    value[n] = '\0';
+    return true;
+}
+#define BACKLOG_SIZE 128
+#define BACKLOG_REPLAY_PER_CYCLE 4
+#define SUMMARY_INTERVAL 600
+struct SensorRecord {
+    uint32_t timestamp;
+    int16_t temp_x10;
+    uint16_t humidity_x10;
+    uint16_t pressure_x10;
+    uint16_t tvoc;
+    uint16_t eco2;
+    uint16_t pm1_0;
+    uint16_t pm2_5;
+    uint16_t pm10;
+    uint16_t particles_03um;
+    uint16_t particles_10um;
+    uint16_t particles_25um;
+    uint8_t pending;
+    uint8_t samples;
+};
+SensorRecord backlog[BACKLOG_SIZE];
+int backlogHead = 0;
+int backlogCount = 0;
+int backlogDropped = 0;
+SensorRecord liveRecord;
+SensorRecord summaryRecord;
+struct SummaryAccumulator {
+    int32_t temp_x10;
+    int32_t humidity_x10;
+    int32_t pressure_x10;
+    int32_t tvoc;
+    int32_t eco2;
+    int32_t pm1_0;
+    int32_t pm2_5;
+    int32_t pm10;
+    int32_t particles_03um;
+    int32_t particles_10um;
+    int32_t particles_25um;
+    int count;
+};
+SummaryAccumulator summary;
+uint32_t lastSummaryUpload = 0;
+void capture_record(SensorRecord* r) {
+    r->timestamp = sensorReadTimer.elapsed_time().count() / 1000000;
+    r->temp_x10 = temp_x10;
+    r->humidity_x10 = humidity_x10;
+    r->pressure_x10 = pressure_x10;
+    r->tvoc = tvoc;
+    r->eco2 = eco2;
+    r->pm1_0 = pm1_0;
+    r->pm2_5 = pm2_5;
+    r->pm10 = pm10;
+    r->particles_03um = particles_03um;
+    r->particles_10um = particles_10um;
+    r->particles_25um = particles_25um;
+    r->pending = UPLOAD_AIR | UPLOAD_FIRE;
+    r->samples = 1;
+}
+bool is_live_record(const SensorRecord* r) {
+    return r == &liveRecord || r == &summaryRecord;
+}
+void summary_add_current() {
+    summary.temp_x10 += temp_x10;
+    summary.humidity_x10 += humidity_x10;
+    summary.pressure_x10 += pressure_x10;
+    summary.tvoc += tvoc;
+    summary.eco2 += eco2;
+    summary.pm1_0 += pm1_0;
+    summary.pm2_5 += pm2_5;
+    summary.pm10 += pm10;
+    summary.particles_03um += particles_03um;
+    summary.particles_10um += particles_10um;
+    summary.particles_25um += particles_25um;
+    summary.count++;
+}
+void summary_take(SensorRecord* r) {
+    int n = summary.count;
+    capture_record(r);
+    r->temp_x10 = summary.temp_x10 / n;
+    r->humidity_x10 = summary.humidity_x10 / n;
+    r->pressure_x10 = summary.pressure_x10 / n;
+    r->tvoc = summary.tvoc / n;
+    r->eco2 = summary.eco2 / n;
+    r->pm1_0 = summary.pm1_0 / n;
+    r->pm2_5 = summary.pm2_5 / n;
+    r->pm10 = summary.pm10 / n;
+    r->particles_03um = summary.particles_03um / n;
+    r->particles_10um = summary.particles_10um / n;
+    r->particles_25um = summary.particles_25um / n;
+    r->samples = n > 255 ? 255 : n;
+    memset(&summary, 0, sizeof(summary));
+}
+void backlog_push(const SensorRecord* r) {
+    if (backlogCount == BACKLOG_SIZE) {
+        backlogHead = (backlogHead + 1) % BACKLOG_SIZE;
+        backlogCount--;
+        backlogDropped++;
+    }
+    backlog[(backlogHead + backlogCount) % BACKLOG_SIZE] = *r;
+    backlogCount++;
+}
+void backlog_trim() {
+    while (backlogCount > 0 && backlog[backlogHead].pending == 0) {
+        backlogHead = (backlogHead + 1) % BACKLOG_SIZE;
+        backlogCount--;
+    }
+}
+void finish_api_update() {
+    backlog_trim();
+    if (liveRecord.pending) {
+        backlog_push(&liveRecord);
+        liveRecord.pending = 0;
+    }
+    if (summaryRecord.pending) {
+        backlog_push(&summaryRecord);
+        summaryRecord.pending = 0;
+    }
+    printf("Backlog: %d queued, %d dropped\n", backlogCount, backlogDropped);
+}
+enum EspState { ESP_IDLE, ESP_PROBE, ESP_RECOVER, ESP_CONNECT, ESP_SEND, ESP_RESPONSE, ESP_CLOSE };
+enum EspJobKind { ESP_JOB_AIR, ESP_JOB_FIRE };
+struct EspJob {
+    EspJobKind kind;
+    const char* path;
+    SensorRecord* record;
+};
+#define ESP_MAX_JOBS (2 + 2 * BACKLOG_REPLAY_PER_CYCLE)
+const char* api_host = "embedapi.botechgida.com";
+EspJob espJobs[ESP_MAX_JOBS];
+int espJobCount = 0;
+int espJobIndex = 0;
+EspState espState = ESP_IDLE;
+bool espRetried = false;
+bool api_keep_alive = true;
+bool espLinkOpen = false;
+bool espLinkRetried = false;
+Timer espTimer;
+int espTimeout = 0;
+char espRx[768] = {0};
+int espRxLen = 0;
+char espBody[512];
+char espRequest[1024];
+void esp_clear() {
+    espRxLen = 0;
+    espRx[0] = '\0';
+}
+void esp_wait(int timeout) {
+    espTimeout = timeout;
+    espTimer.reset();
+    espTimer.start();
+}
+void esp_command(const char* cmd, int timeout) {
+    esp_clear();
     send_esp(cmd);
-    read_esp(3000, ">");
-    esp.write(req, strlen(req));
-    printf("Sent POST to %s%s\n", host, path);
-    read_esp(10000);
-    send_esp("AT+CIPCLOSE");
-    read_esp(3000, "OK");
+    esp_wait(timeout);
+}
+void esp_pump() {
+    char chunk[64];
+    while (esp.readable()) {
+        int n = esp.read(chunk, sizeof(chunk));
+        if (n <= 0) break;
+        int room = (int)sizeof(espRx) - 1 - espRxLen;
+        if (n > room) n = room;
+        memcpy(espRx + espRxLen, chunk, n);
+        espRxLen += n;
+        espRx[espRxLen] = '\0';
+    }
+}
+bool esp_timed_out() {
+    return espTimer.elapsed_time() >= chrono::milliseconds(espTimeout);
+}
+int esp_status(const char* success_text) {
+    if (strstr(espRx, success_text)) return 1;
+    if (strstr(espRx, "ERROR") || strstr(espRx, "FAIL") || esp_timed_out()) return -1;
+    return 0;
+}
+bool esp_http_complete() {
+    const char* ipd = strstr(espRx, "+IPD,");
+    if (ipd == NULL) return false;
+    if (strstr(ipd, "CLOSED")) return true;
+    const char* body = strstr(ipd, "\r\n\r\n");
+    const char* length = strstr(ipd, "ontent-length:");
+    if (length == NULL) length = strstr(ipd, "ontent-Length:");
+    if (body == NULL || length == NULL) return false;
+    return (int)strlen(body + 4) >= atoi(length + 14);
+}
+bool parse_api_response(const EspJob* job) {
+    const char* http = strstr(espRx, "HTTP/1.1 ");
+    if (http == NULL || atoi(http + 9) != 200) return false;
+    const char* body = strstr(http, "\r\n\r\n");
+    if (body == NULL) return false;
+    body += 4;
+    bool verdict;
+    float probability;
+    char message[64] = "";
+    bool ok;
+    if (job->kind == ESP_JOB_AIR) {
+        ok = json_bool(body, "is_unsafe", &verdict) && json_float(body, "probability", &probability);
+    } else {
+        ok = json_bool(body, "is_fire_detected", &verdict) && json_float(body, "probability", &probability);
+    }
+    // Only the current reading's verdict is shown; summaries and replayed backlog just need a valid reply.
+    if (!ok || job->record != &liveRecord) return ok;
+    bool hasMessage = json_string(body, "message", message, sizeof(message));
+    if (job->kind == ESP_JOB_AIR) {
+        apiAirIsUnsafe = verdict;
+        apiAirProbability = probability;
+        if (hasMessage) strcpy(apiAirMessage, message);
+    } else {
+        apiFireDetected = verdict;
+        apiFireProbability = probability;
+        if (hasMessage) strcpy(apiFireMessage, message);
+    }
     return true;
 }
-bool send_air_quality_data() {
-    if (!wifi_connected) return false;
-    char body[512];
-    snprintf(body, sizeof(body), 
+void esp_connect() {
+    char cmd[128];
+    sprintf(cmd, "AT+CIPSTART=\"TCP\",\"%s\",80", api_host);
+    esp_command(cmd, 5000);
+    espState = ESP_CONNECT;
+}
+void format_air_quality_body(const SensorRecord* r, const char* extra) {
+    snprintf(espBody, sizeof(espBody), 
         "{\"device_id\":\"k64f-monitor\","
         "\"co2\":%d,"
         "\"pm2_5\":%d,"
@@ -460,26 +797,23 @@ bool send_air_quality_data() {
         "\"pm10_category\":%d,"
         "\"hour\":%d,"
         "\"day_of_week\":%d,"
-        "\"is_weekend\":%d}",
-        eco2,
-        pm2_5,
-        pm10,
-        (float)temp_x10 / 10.0f,
-        (float)humidity_x10 / 10.0f,
-        (eco2 > 1000) ? 2 : ((eco2 > 800) ? 1 : 0),
-        (pm2_5 > 25) ? 2 : ((pm2_5 > 12) ? 1 : 0),
-        (pm10 > 50) ? 2 : ((pm10 > 25) ? 1 : 0),
+        "\"is_weekend\":%d%s}",
+        r->eco2,
+        r->pm2_5,
+        r->pm10,
+        (float)r->temp_x10 / 10.0f,
+        (float)r->humidity_x10 / 10.0f,
+        (r->eco2 > 1000) ? 2 : ((r->eco2 > 800) ? 1 : 0),
+        (r->pm2_5 > 25) ? 2 : ((r->pm2_5 > 12) ? 1 : 0),
+        (r->pm10 > 50) ? 2 : ((r->pm10 > 25) ? 1 : 0),
         12,
         3,
-        0
+        0,
+        extra
     );
-    printf("Sending Air Quality API data: %s\n", body);
-    return sendPost("embedapi.botechgida.com", "/api/predict", body);
 }
-bool send_fire_detection_data() {
-    if (!wifi_connected) return false;
-    char body[512];
-    snprintf(body, sizeof(body), 
+void format_fire_detection_body(const SensorRecord* r, const char* extra) {
+    snprintf(espBody, sizeof(espBody), 
         "{\"device_id\":\"k64f-monitor\","
         "\"temperature\":%.1f,"
         "\"humidity\":%.1f,"
@@ -492,20 +826,239 @@ bool send_fire_detection_data() {
         "\"pm2_5\":%d,"
         "\"nc0_5\":%d,"
         "\"nc1_0\":%d,"
-        "\"nc2_5\":%d}",
-        (float)temp_x10 / 10.0f,
-        (float)humidity_x10 / 10.0f,
-        tvoc,
-        eco2,
-        (float)pressure_x10 / 10.0f,
-        pm1_0,
-        pm2_5,
-        particles_03um,
-        particles_10um,
-        particles_25um
+        "\"nc2_5\":%d%s}",
+        (float)r->temp_x10 / 10.0f,
+        (float)r->humidity_x10 / 10.0f,
+        r->tvoc,
+        r->eco2,
+        (float)r->pressure_x10 / 10.0f,
+        r->pm1_0,
+        r->pm2_5,
+        r->particles_03um,
+        r->particles_10um,
+        r->particles_25um,
+        extra
     );
-    printf("Sending Fire API data: %s\n", body);
-    return sendPost("embedapi.botechgida.com", "/api/predict-fire", body);
+}
+void esp_send_request(const EspJob* job) {
+    char cmd[32];
+    char extra[128] = "";
+    int n = 0;
+    if (job->record->samples > 1) {
+        n = snprintf(extra, sizeof(extra), ",\"samples\":%d", job->record->samples);
+    }
+    if (!is_live_record(job->record)) {
+        uint32_t now = sensorReadTimer.elapsed_time().count() / 1000000;
+        snprintf(extra + n, sizeof(extra) - n, ",\"age_s\":%lu", (unsigned long)(now - job->record->timestamp));
+    }
+    if (job->record == &liveRecord && job->kind == ESP_JOB_FIRE) {
+        snprintf(extra + n, sizeof(extra) - n, ",\"temp_slope\":%.2f,\"tvoc_slope\":%.1f,\"pm2_5_slope\":%.1f,\"rise_alert\":%s",
+            tempTrend.slope, tvocTrend.slope, pm25Trend.slope, riseAlert ? "true" : "false");
+    }
+    if (job->kind == ESP_JOB_AIR) {
+        format_air_quality_body(job->record, extra);
+    } else {
+        format_fire_detection_body(job->record, extra);
+    }
+    sprintf(espRequest,
+        "POST %s HTTP/1.1\r\n"
+        "Host: %s\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: %d\r\n"
+        "%s\r\n"
+        "%s", job->path, api_host, (int)strlen(espBody), api_keep_alive ? "Connection: keep-alive\r\n" : "", espBody);
+    sprintf(cmd, "AT+CIPSEND=%d", (int)strlen(espRequest));
+    esp_command(cmd, 3000);
+    espState = ESP_SEND;
+}
+bool esp_reconnect() {
+    if (espLinkRetried) return false;
+    espLinkRetried = true;
+    espLinkOpen = false;
+    esp_connect();
+    return true;
+}
+void esp_next_job() {
+    if (espJobIndex >= espJobCount) {
+        printf("API update: Air %s, Fire %s\n", api_air_success ? "OK" : "Failed", api_fire_success ? "OK" : "Failed");
+        finish_api_update();
+        espJobCount = 0;
+        espJobIndex = 0;
+        esp_clear();
+        espState = ESP_IDLE;
+        return;
+    }
+    espLinkRetried = false;
+    if (espLinkOpen) {
+        esp_send_request(&espJobs[espJobIndex]);
+    } else {
+        esp_connect();
+    }
+}
+void esp_set_live_result(const EspJob* job, bool success) {
+    if (job->record != &liveRecord) return;
+    if (job->kind == ESP_JOB_AIR) {
+        api_air_success = success;
+    } else {
+        api_fire_success = success;
+    }
+}
+void esp_finish_job(bool success) {
+    EspJob* job = &espJobs[espJobIndex];
+    if (success) job->record->pending &= ~(job->kind == ESP_JOB_AIR ? UPLOAD_AIR : UPLOAD_FIRE);
+    esp_set_live_result(job, success);
+    printf("POST %s%s: %s\n", job->path, job->record == &liveRecord ? "" : (job->record == &summaryRecord ? " (summary)" : " (backlog)"), success ? "OK" : "Failed");
+    if (success && api_keep_alive && espLinkOpen) {
+        espJobIndex++;
+        esp_next_job();
+        return;
+    }
+    if (!success) {
+        for (int i = espJobIndex + 1; i < espJobCount; i++) esp_set_live_result(&espJobs[i], false);
+        espJobCount = espJobIndex + 1;
+    }
+    espLinkOpen = false;
+    esp_command("AT+CIPCLOSE", 3000);
+    espState = ESP_CLOSE;
+}
+void esp_task() {
+    esp_pump();
+    if (espState == ESP_IDLE) {
+        if (strstr(espRx, "CLOSED")) espLinkOpen = false;
+        esp_clear();
+        return;
+    }
+    EspJob* job = &espJobs[espJobIndex];
+    int status;
+    switch (espState) {
+        case ESP_PROBE:
+            status = esp_status("OK");
+            if (status > 0) {
+                wifi_connected = true;
+                esp_next_job();
+            } else if (status < 0 && !espRetried) {
+                espRetried = true;
+                espLinkOpen = false;
+                esp_command("AT+CIPCLOSE", 1000);
+                espState = ESP_RECOVER;
+            } else if (status < 0) {
+                wifi_connected = false;
+                api_air_success = false;
+                api_fire_success = false;
+                printf("API update skipped: WiFi offline\n");
+                finish_api_update();
+                espJobCount = 0;
+                espJobIndex = 0;
+                espState = ESP_IDLE;
+            }
+            break;
+        case ESP_RECOVER:
+            if (esp_status("OK") != 0) {
+                esp_command("AT", 2000);
+                espState = ESP_PROBE;
+            }
+            break;
+        case ESP_CONNECT:
+            status = esp_status("CONNECT");
+            if (status > 0) {
+                espLinkOpen = true;
+                esp_send_request(job);
+            } else if (status < 0) {
+                esp_finish_job(false);
+            }
+            break;
+        case ESP_SEND:
+            status = esp_status(">");
+            if (status > 0) {
+                esp_clear();
+                esp.write(espRequest, strlen(espRequest));
+                printf("Sent POST to %s%s\n", api_host, job->path);
+                esp_wait(10000);
+                espState = ESP_RESPONSE;
+            } else if (status < 0 && !esp_reconnect()) {
+                esp_finish_job(false);
+            }
+            break;
+        case ESP_RESPONSE:
+            if (esp_http_complete()) {
+                if (strstr(espRx, "CLOSED")) espLinkOpen = false;
+                esp_finish_job(parse_api_response(job));
+            } else if (strstr(espRx, "CLOSED") || strstr(espRx, "SEND FAIL") || esp_timed_out()) {
+                // The request may already have been stored, so it is never re-sent here;
+                // the record stays pending and is replayed from the backlog.
+                esp_finish_job(false);
+            }
+            break;
+        case ESP_CLOSE:
+            if (esp_status("OK") != 0) {
+                espJobIndex++;
+                esp_next_job();
+            }
+            break;
+        default:
+            break;
+    }
+}
+bool esp_queue(EspJobKind kind, const char* path, SensorRecord* record) {
+    if (espJobCount >= ESP_MAX_JOBS) return false;
+    EspJob* job = &espJobs[espJobCount++];
+    job->kind = kind;
+    job->path = path;
+    job->record = record;
+    return true;
+}
+bool send_air_quality_data(SensorRecord* record) {
+    return esp_queue(ESP_JOB_AIR, "/api/predict", record);
+}
+bool send_fire_detection_data(SensorRecord* record) {
+    return esp_queue(ESP_JOB_FIRE, "/api/predict-fire", record);
+}
+void start_api_update() {
+    if (espState != ESP_IDLE) {
+        printf("API update skipped: previous update still running\n");
+        return;
+    }
+    uint32_t now = sensorReadTimer.elapsed_time().count() / 1000000;
+    uint8_t escalated = (zoneEscalate ? UPLOAD_AIR : 0) | (fireEscalate ? UPLOAD_FIRE : 0);
+    uint8_t summaryTargets = edgeClear & ~escalated;
+    bool summaryDue = summaryTargets != 0 && summary.count > 0 && now - lastSummaryUpload >= SUMMARY_INTERVAL;
+    if (escalated == 0 && !summaryDue && backlogCount == 0) {
+        printf("API update skipped: edge results confident (fire %s, zone %s)\n", fireStatus, zoneStatus);
+        return;
+    }
+    espJobCount = 0;
+    espJobIndex = 0;
+    capture_record(&liveRecord);
+    liveRecord.pending = escalated;
+    summaryRecord.pending = 0;
+    if (summaryDue) {
+        summary_take(&summaryRecord);
+        summaryRecord.pending = summaryTargets;
+        lastSummaryUpload = now;
+    }
+    if (liveRecord.pending & UPLOAD_AIR) {
+        send_air_quality_data(&liveRecord);
+        lastAirLiveUpload = now;
+    }
+    if (liveRecord.pending & UPLOAD_FIRE) {
+        send_fire_detection_data(&liveRecord);
+        lastFireLiveUpload = now;
+    }
+    if (summaryRecord.pending & UPLOAD_AIR) send_air_quality_data(&summaryRecord);
+    if (summaryRecord.pending & UPLOAD_FIRE) send_fire_detection_data(&summaryRecord);
+    fireEscalate = false;
+    zoneEscalate = false;
+    int replayed = 0;
+    for (int i = 0; i < backlogCount && replayed < BACKLOG_REPLAY_PER_CYCLE; i++) {
+        SensorRecord* r = &backlog[(backlogHead + i) % BACKLOG_SIZE];
+        if (r->pending == 0) continue;
+        if (r->pending & UPLOAD_AIR) send_air_quality_data(r);
+        if (r->pending & UPLOAD_FIRE) send_fire_detection_data(r);
+        replayed++;
+    }
+    espRetried = false;
+    esp_command("AT", 2000);
+    espState = ESP_PROBE;
 }
 void updateDisplay() {
     lcd.cls();
@@ -637,6 +1190,8 @@ int main() {
     uint32_t pm10_sum = 0;
     while (true) {
         led = !led;
+        pms_poll();
+        esp_task();
         if (!systemStarted && buttonPressed) {
             buttonPressed = false;
             systemStarted = true;
@@ -683,19 +1238,9 @@ int main() {
             pm10 = pm10_sum / 3;
             printf("Averaged data from initial readings.\n");
             makePredictions();
-            if (wifi_connected) {
-                lcd.cls();
-                lcd.locate(0, 0);
-                lcd.printf("Sending to cloud");
-                api_air_success = send_air_quality_data();
-                ThisThread::sleep_for(3000ms);
-                api_fire_success = send_fire_detection_data();
-                lcd.locate(0, 2);
-                lcd.printf("Air API: %s", api_air_success ? "OK" : "Failed");
-                lcd.locate(0, 3);
-                lcd.printf("Fire API: %s", api_fire_success ? "OK" : "Failed");
-                ThisThread::sleep_for(2000ms);
-            }
+            if (edgeClear) summary_add_current();
+            start_api_update();
+            lastSummaryUpload = sensorReadTimer.elapsed_time().count() / 1000000;
             lastSensorUpdate = sensorReadTimer.elapsed_time().count() / 1000000;
             lastDisplayChange = lastSensorUpdate;
             last_api_update = lastSensorUpdate;
@@ -708,18 +1253,9 @@ int main() {
             if (currentTime - lastSensorUpdate >= 30) {
                 readAllSensors();
                 makePredictions();
-                if (currentTime - last_api_update >= api_update_interval) {
-                    check_wifi_connection();
-                    if (wifi_connected) {
-                        api_air_success = send_air_quality_data();
-                        ThisThread::sleep_for(3000ms);
-                        api_fire_success = send_fire_detection_data();
-                        printf("API update: Air %s, Fire %s\n", api_air_success ? "OK" : "Failed", api_fire_success ? "OK" : "Failed");
-                    } else {
-                        api_air_success = false;
-                        api_fire_success = false;
-                        printf("API update skipped: WiFi offline\n");
-                    }
+                if (edgeClear) summary_add_current();
+                if (fireEscalate || zoneEscalate || currentTime - last_api_update >= api_update_interval) {
+                    start_api_update();
                     last_api_update = currentTime;
                 }
                 lastSensorUpdate = currentTime;
@@ -734,6 +1270,6 @@ int main() {
             }
             updateBuzzer();
         }
-        ThisThread::sleep_for(100ms);
+        ThisThread::sleep_for(espState == ESP_IDLE ? 100ms : 10ms);
     }
 }
\ No newline at end of file
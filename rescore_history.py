@@ -0,0 +1,244 @@
+"""Re-score stored readings, or a dataset CSV, with a retrained model.
+
+Rows are streamed in chunks and scored across a process pool. The model and
+scaler are exported once to flat arrays beside the pickle (see
+flat_forest.py), and every worker memory-maps that export instead of
+unpickling its own copy.
+
+For the database, results go into new ``prediction_<version>`` and
+``probability_<version>`` columns, so the original ``prediction`` and
+``probability`` stay intact. Each chunk is written in one transaction
+together with its checkpoint. For a CSV, the scored rows are appended to
+``--output`` and the checkpoint is kept beside it. In both cases an
+interrupted run resumes where it stopped.
+
+Rows with a missing input are not scored: they get an empty prediction and
+probability, and the checkpoint still moves past them.
+
+Example::
+
+    python3 rescore_history.py air
+    python3 rescore_history.py fire --model-file model/versions/<version>/fire_detection_model.pkl
+    python3 rescore_history.py air --csv Numerically_Encoded_Air_Quality_Dataset.csv --output air_scored.csv
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from flat_forest import FlatForest, ensure_export
+from train_models import MODELS, prepare_frame, sha256_file
+
+# Table and columns the API stores each model's inputs in, in model feature order.
+TABLES = {
+    "air": ("air_quality_data", [
+        "co2", "pm2_5", "pm10", "temperature", "humidity",
+        "co2_category", "pm2_5_category", "pm10_category",
+        "hour", "day_of_week", "is_weekend",
+    ]),
+    "fire": ("fire_detection_data", [
+        "temperature", "humidity", "tvoc", "eco2", "raw_h2", "raw_ethanol",
+        "pressure", "pm1_0", "pm2_5", "nc0_5", "nc1_0", "nc2_5",
+    ]),
+}
+
+_model = None
+
+
+def init_worker(flat_path):
+    global _model
+    _model = FlatForest.load(flat_path)
+
+
+def score(X):
+    """Return (prediction, probability of the positive class, scored mask) for a chunk of rows.
+
+    Rows with a missing input are left out; their prediction is 0 and their
+    probability NaN, and the caller stores them as missing.
+    """
+    scored = ~np.isnan(X).any(axis=1)
+    predictions = np.zeros(len(X), dtype=int)
+    probabilities = np.full(len(X), np.nan)
+    if scored.any():
+        proba = _model.predict_proba(X[scored])
+        positive = list(_model.classes_).index(1) if 1 in _model.classes_ else proba.shape[1] - 1
+        predictions[scored] = _model.classes_[proba.argmax(axis=1)]
+        probabilities[scored] = proba[:, positive]
+    return predictions, probabilities, scored
+
+
+def model_version(model_path):
+    """Version tag from the manifest train_models.py writes beside the model, else a hash of the file."""
+    manifest = os.path.join(os.path.dirname(model_path), "manifest.json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            return json.load(f)["version"]
+    return "sha" + sha256_file(model_path)[:8]
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    def update(self, rows, skipped=0):
+        self.done += rows
+        self.skipped += skipped
+        rate = self.done / max(time.perf_counter() - self.started, 1e-9)
+        total = "/%d" % self.total if self.total is not None else ""
+        missing = ", %d with missing inputs" % self.skipped if self.skipped else ""
+        print("  %d%s rows%s, %.0f rows/s" % (self.done, total, missing, rate))
+
+
+def pipeline(pool, chunks, workers, write):
+    """Score chunks in the pool with a bounded number in flight, writing results in input order."""
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append((chunk, pool.submit(score, chunk[1])))
+        if len(pending) >= 2 * workers:
+            head, future = pending.popleft()
+            write(head, *future.result())
+    while pending:
+        head, future = pending.popleft()
+        write(head, *future.result())
+
+
+def rescore_db(args, pool, spec_columns, table, version):
+    conn = sqlite3.connect(args.db)
+    prediction_col, probability_col = "prediction_" + version, "probability_" + version
+    existing = {row[1] for row in conn.execute('PRAGMA table_info("%s")' % table)}
+    with conn:
+        if prediction_col not in existing:
+            conn.execute('ALTER TABLE "%s" ADD COLUMN "%s" INTEGER' % (table, prediction_col))
+            conn.execute('ALTER TABLE "%s" ADD COLUMN "%s" REAL' % (table, probability_col))
+        conn.execute("CREATE TABLE IF NOT EXISTS rescore_checkpoint "
+                     "(source TEXT, version TEXT, last_id INTEGER, PRIMARY KEY (source, version))")
+        if args.restart:
+            conn.execute("DELETE FROM rescore_checkpoint WHERE source = ? AND version = ?", (table, version))
+    row = conn.execute("SELECT last_id FROM rescore_checkpoint WHERE source = ? AND version = ?",
+                       (table, version)).fetchone()
+    last_id = row[0] if row else 0
+    if last_id:
+        print("Resuming after id %d" % last_id)
+    total = conn.execute('SELECT COUNT(*) FROM "%s" WHERE id > ?' % table, (last_id,)).fetchone()[0]
+    print("Re-scoring %d rows of %s into %s" % (total, table, prediction_col))
+    progress = Progress(total)
+    select = 'SELECT id, %s FROM "%s" WHERE id > ? ORDER BY id LIMIT ?' % (
+        ", ".join('"%s"' % c for c in spec_columns), table)
+    update = 'UPDATE "%s" SET "%s" = ?, "%s" = ? WHERE id = ?' % (table, prediction_col, probability_col)
+
+    def chunks():
+        cursor = last_id
+        while True:
+            rows = conn.execute(select, (cursor, args.chunk_size)).fetchall()
+            if not rows:
+                return
+            data = np.array(rows, dtype=float)
+            cursor = int(data[-1, 0])
+            yield data[:, 0].astype(np.int64), data[:, 1:]
+
+    def write(chunk, predictions, probabilities, scored):
+        ids = chunk[0]
+        # Rows with a NULL input keep NULL results but still count as done.
+        results = [(p, q, i) if ok else (None, None, i)
+                   for p, q, i, ok in zip(predictions.tolist(), probabilities.tolist(), ids.tolist(), scored)]
+        with conn:
+            conn.executemany(update, results)
+            conn.execute("INSERT OR REPLACE INTO rescore_checkpoint VALUES (?, ?, ?)", (table, version, int(ids[-1])))
+        progress.update(len(ids), int((~scored).sum()))
+
+    pipeline(pool, chunks(), args.workers, write)
+    conn.close()
+    return progress
+
+
+def rescore_csv(args, pool, spec, version):
+    checkpoint_path = args.output + ".checkpoint"
+    state = {"rows": 0, "offset": 0}
+    if not args.restart and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        if state.get("version") != version:
+            raise SystemExit("%s belongs to version %s; pass --restart" % (checkpoint_path, state.get("version")))
+        print("Resuming after row %d" % state["rows"])
+    out = open(args.output, "r+" if state["rows"] else "w")
+    out.truncate(state["offset"])
+    out.seek(state["offset"])
+    progress = Progress(None)
+
+    def chunks():
+        reader = pd.read_csv(args.csv, chunksize=args.chunk_size, skiprows=range(1, state["rows"] + 1))
+        for frame in reader:
+            if frame.empty:
+                continue
+            # Drop the index pandas wrote into the dataset export, so it is not carried into --output.
+            frame = frame.loc[:, ~frame.columns.str.startswith("Unnamed:")]
+            frame = prepare_frame(spec, frame, args.csv, require_target=False)
+            yield frame, frame[spec["features"]].to_numpy(dtype=float)
+
+    def write(chunk, predictions, probabilities, scored):
+        frame = chunk[0].copy()
+        frame["prediction_" + version] = pd.array(np.where(scored, predictions, None), dtype="Int64")
+        frame["probability_" + version] = probabilities
+        frame.to_csv(out, header=state["offset"] == 0, index=False)
+        out.flush()
+        state.update(rows=state["rows"] + len(frame), offset=out.tell(), version=version)
+        with open(checkpoint_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        progress.update(len(frame), int((~scored).sum()))
+
+    print("Scoring %s into %s" % (args.csv, args.output))
+    pipeline(pool, chunks(), args.workers, write)
+    out.close()
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score stored history or a dataset CSV with a model.")
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument("--db", default="sensor_data.db")
+    parser.add_argument("--csv", help="score this CSV instead of the database")
+    parser.add_argument("--output", help="scored CSV to write (required with --csv)")
+    parser.add_argument("--model-file", help="pickled model (default: model/<model file>)")
+    parser.add_argument("--scaler-file", help="pickled scaler (default: next to the model file)")
+    parser.add_argument("--version", help="tag for the new columns (default: manifest version or model hash)")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--restart", action="store_true", help="ignore any checkpoint and start over")
+    args = parser.parse_args()
+    if args.csv and not args.output:
+        parser.error("--output is required with --csv")
+
+    spec = MODELS[args.model]
+    model_path = args.model_file or os.path.join("model", spec["model_file"])
+    scaler_path = args.scaler_file or os.path.join(os.path.dirname(model_path), spec["scaler_file"])
+    version = re.sub(r"\W", "_", args.version or model_version(model_path))
+    table, columns = TABLES[args.model]
+    flat_path = ensure_export(model_path, scaler_path, spec["features"])
+
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(flat_path,)) as pool:
+        if args.csv:
+            progress = rescore_csv(args, pool, spec, version)
+        else:
+            progress = rescore_db(args, pool, columns, table, version)
+    elapsed = time.perf_counter() - progress.started
+    print("Done: %d rows in %.1f s (%.0f rows/s)" % (progress.done, elapsed, progress.done / max(elapsed, 1e-9)))
+    if progress.skipped:
+        print("%d rows had missing inputs and were left unscored" % progress.skipped)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
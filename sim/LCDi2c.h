@@ -0,0 +1,30 @@
+#ifndef SIM_LCDI2C_H
+#define SIM_LCDI2C_H
+
+#include <cstdarg>
+#include <cstdio>
+
+#include "sim.h"
+
+enum lcd_t { LCD16x2, LCD20x2, LCD20x4 };
+
+class LCDi2c {
+public:
+    LCDi2c(PinName sda, PinName scl, lcd_t type = LCD16x2, int address = 0x27) {}
+    void cls() {
+        sim::lcd_command(1);
+        sim::busy_us(1520);
+    }
+    void locate(int column, int row) { sim::lcd_command(1); }
+    int printf(const char* format, ...) {
+        char text[64];
+        va_list args;
+        va_start(args, format);
+        int n = vsnprintf(text, sizeof(text), format, args);
+        va_end(args);
+        if (n > 0) sim::lcd_command(n < (int)sizeof(text) ? n : (int)sizeof(text) - 1);
+        return n;
+    }
+};
+
+#endif
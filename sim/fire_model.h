@@ -0,0 +1,17 @@
+// Host stand-in for the generated fire model. Drop the real fire_model.h
+// next to the firmware source to simulate with the trained forest instead.
+#pragma once
+namespace Eloquent {
+    namespace ML {
+        namespace Port {
+            class RandomForest {
+                public:
+                    int predict(float *x) {
+                        if (x[0] >= 50.0f || x[2] >= 1500.0f) return 2;
+                        if (x[0] >= 35.0f || x[2] >= 600.0f) return 1;
+                        return 0;
+                    }
+            };
+        }
+    }
+}
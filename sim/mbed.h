@@ -0,0 +1,113 @@
+#ifndef SIM_MBED_H
+#define SIM_MBED_H
+
+#include <chrono>
+#include <cstddef>
+#include <cstdint>
+#include <cstdio>
+#include <functional>
+#include <sys/types.h>
+
+#include "sim.h"
+
+namespace mbed {
+
+template <typename F>
+class Callback;
+
+template <>
+class Callback<void()> : public std::function<void()> {
+public:
+    using std::function<void()>::function;
+};
+
+class I2C {
+public:
+    I2C(PinName sda, PinName scl) {}
+    void frequency(int hz) { sim::i2c_frequency(hz); }
+    int write(int address, const char* data, int length, bool repeated = false) {
+        return sim::i2c_write(address, data, length);
+    }
+    int read(int address, char* data, int length, bool repeated = false) {
+        return sim::i2c_read(address, data, length);
+    }
+};
+
+class DigitalOut {
+public:
+    DigitalOut(PinName pin, int value = 0) : _value(value) {}
+    DigitalOut& operator=(int value) { _value = value; return *this; }
+    operator int() const { return _value; }
+private:
+    int _value;
+};
+
+class InterruptIn {
+public:
+    InterruptIn(PinName pin) : _pin(pin) {}
+    void rise(Callback<void()> func) { sim::attach_rise(_pin, func); }
+    void fall(Callback<void()> func) {}
+private:
+    PinName _pin;
+};
+
+class SerialBase {
+public:
+    enum IrqType { RxIrq = 0, TxIrq };
+};
+
+class BufferedSerial : public SerialBase {
+public:
+    BufferedSerial(PinName tx, PinName rx, int baud = 9600) : _port(sim::open_serial(tx, baud, true)) {}
+    bool readable() const { return sim::serial_readable(_port); }
+    bool writable() const { return true; }
+    ssize_t read(void* buffer, size_t length) { return sim::serial_read(_port, buffer, length); }
+    ssize_t write(const void* buffer, size_t length) { return sim::serial_write(_port, buffer, length); }
+    int set_blocking(bool blocking) { sim::serial_set_blocking(_port, blocking); return 0; }
+private:
+    int _port;
+};
+
+class UnbufferedSerial : public SerialBase {
+public:
+    UnbufferedSerial(PinName tx, PinName rx, int baud = 9600) : _port(sim::open_serial(tx, baud, false)) {}
+    bool readable() const { return sim::serial_readable(_port); }
+    bool writable() const { return true; }
+    ssize_t read(void* buffer, size_t length) { return sim::serial_read(_port, buffer, length); }
+    ssize_t write(const void* buffer, size_t length) { return sim::serial_write(_port, buffer, length); }
+    void attach(Callback<void()> func, IrqType type = RxIrq) {
+        if (type == RxIrq) sim::serial_attach(_port, func);
+    }
+private:
+    int _port;
+};
+
+class Timer {
+public:
+    void start() { if (!_running) { _started = sim::now_us(); _running = true; } }
+    void stop() { if (_running) { _accumulated += sim::now_us() - _started; _running = false; } }
+    void reset() { _accumulated = 0; _started = sim::now_us(); }
+    std::chrono::microseconds elapsed_time() const {
+        sim::poll_cost();
+        int64_t us = _accumulated + (_running ? sim::now_us() - _started : 0);
+        return std::chrono::microseconds(us);
+    }
+private:
+    int64_t _started = 0;
+    int64_t _accumulated = 0;
+    bool _running = false;
+};
+
+namespace ThisThread {
+inline void sleep_for(std::chrono::milliseconds duration) { sim::sleep_us(duration.count() * 1000); }
+}
+
+}
+
+inline void core_util_critical_section_enter() { sim::critical_section(true); }
+inline void core_util_critical_section_exit() { sim::critical_section(false); }
+
+using namespace mbed;
+using namespace std;
+
+#endif
@@ -0,0 +1,874 @@
+#include "sim.h"
+
+#include <algorithm>
+#include <arpa/inet.h>
+#include <cctype>
+#include <cerrno>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <cxxabi.h>
+#include <deque>
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <map>
+#include <memory>
+#include <netdb.h>
+#include <poll.h>
+#include <string>
+#include <sys/socket.h>
+#include <unistd.h>
+#include <vector>
+
+int firmware_main();
+
+namespace sim {
+
+struct Config {
+    double duration_s = 300.0;
+    double press_at_s = 20.0;
+    double tick_ms = 100.0;
+    double min_iter_ms = 1.0;
+    double net_latency_ms = 80.0;
+    double keepalive_s = 5.0;
+    double outage_from_s = -1.0;
+    double outage_to_s = -1.0;
+    std::string scenario;
+    std::string http = "canned";
+    std::string json;
+    std::string pms_capture;
+    std::vector<std::pair<std::string, unsigned long>> expect;
+    bool quiet = false;
+    bool report = true;
+};
+
+static Config config;
+static int64_t clock_us = 0;
+static int64_t end_us = 0;
+static int i2c_hz = 100000;
+
+static void finish();
+
+#define NO_INSTRUMENT __attribute__((no_instrument_function))
+
+// Scenario: sensor values over simulated time, linearly interpolated.
+
+struct Reading {
+    double t_s = 0;
+    double temperature = 21.5, humidity = 45.0, pressure = 1013.2;
+    double tvoc = 120, eco2 = 520, aqi = 2;
+    double pm1_0 = 4, pm2_5 = 7, pm10 = 11;
+    double nc0_3 = 900, nc0_5 = 260, nc1_0 = 40, nc2_5 = 6, nc5_0 = 1, nc10 = 0;
+};
+
+static const char* reading_columns[] = {
+    "t_s", "temperature", "humidity", "pressure", "tvoc", "eco2", "aqi",
+    "pm1_0", "pm2_5", "pm10", "nc0_3", "nc0_5", "nc1_0", "nc2_5", "nc5_0", "nc10",
+};
+static const int reading_column_count = sizeof(reading_columns) / sizeof(reading_columns[0]);
+
+static double* reading_field(Reading& r, int column) {
+    double* fields[] = {
+        &r.t_s, &r.temperature, &r.humidity, &r.pressure, &r.tvoc, &r.eco2, &r.aqi,
+        &r.pm1_0, &r.pm2_5, &r.pm10, &r.nc0_3, &r.nc0_5, &r.nc1_0, &r.nc2_5, &r.nc5_0, &r.nc10,
+    };
+    return fields[column];
+}
+
+static double reading_field(const Reading& r, int column) { return *reading_field(const_cast<Reading&>(r), column); }
+
+static std::vector<Reading> scenario(1);
+
+static void load_scenario(const std::string& path) {
+    FILE* f = fopen(path.c_str(), "r");
+    if (!f) {
+        fprintf(stderr, "firmware_sim: cannot open scenario %s\n", path.c_str());
+        exit(2);
+    }
+    std::vector<int> columns;
+    std::vector<Reading> rows;
+    char line[1024];
+    while (fgets(line, sizeof(line), f)) {
+        if (line[0] == '#' || line[0] == '\n' || line[0] == '\r') continue;
+        std::vector<std::string> cells;
+        for (char* cell = strtok(line, ",\r\n"); cell; cell = strtok(nullptr, ",\r\n")) cells.push_back(cell);
+        if (columns.empty()) {
+            for (auto& name : cells) {
+                int column = -1;
+                for (int i = 0; i < reading_column_count; i++) {
+                    if (name == reading_columns[i]) column = i;
+                }
+                if (column < 0) {
+                    fprintf(stderr, "firmware_sim: unknown scenario column %s\n", name.c_str());
+                    exit(2);
+                }
+                columns.push_back(column);
+            }
+            continue;
+        }
+        Reading r = rows.empty() ? Reading() : rows.back();
+        for (size_t i = 0; i < cells.size() && i < columns.size(); i++) {
+            *reading_field(r, columns[i]) = atof(cells[i].c_str());
+        }
+        rows.push_back(r);
+    }
+    fclose(f);
+    if (rows.empty()) {
+        fprintf(stderr, "firmware_sim: scenario %s has no rows\n", path.c_str());
+        exit(2);
+    }
+    scenario = rows;
+}
+
+static Reading sample(int64_t at_us) {
+    double t = at_us / 1e6;
+    if (t <= scenario.front().t_s) return scenario.front();
+    for (size_t i = 1; i < scenario.size(); i++) {
+        const Reading& a = scenario[i - 1];
+        const Reading& b = scenario[i];
+        if (t < b.t_s) {
+            double k = (t - a.t_s) / (b.t_s - a.t_s);
+            Reading r = a;
+            for (int c = 1; c < reading_column_count; c++) {
+                *reading_field(r, c) = reading_field(a, c) + k * (reading_field(b, c) - reading_field(a, c));
+            }
+            return r;
+        }
+    }
+    return scenario.back();
+}
+
+// Profiler: -finstrument-functions hooks, accounted in simulated time.
+
+struct Stat {
+    long calls = 0;
+    int64_t incl = 0, self = 0, sleep = 0, max_incl = 0;
+};
+
+struct Frame {
+    void* fn;
+    int64_t start;
+    int64_t child;
+};
+
+struct Iteration {
+    long index;
+    int64_t start, end;
+    std::map<void*, Stat> stats;
+};
+
+static std::vector<Frame> stack;
+static void* main_fn = nullptr;
+static std::map<void*, Stat> totals;
+static std::map<void*, Stat> current;
+static std::vector<Iteration> iterations;
+static long iteration_count = 0;
+static int64_t iteration_start = 0;
+static int64_t iteration_children = 0;
+static bool profiling = false;
+
+NO_INSTRUMENT static std::string function_name(void* fn) {
+    if (fn == main_fn) return "main";
+    Dl_info info;
+    if (!dladdr(fn, &info) || !info.dli_sname) {
+        char buf[32];
+        snprintf(buf, sizeof(buf), "%p", fn);
+        return buf;
+    }
+    int status = 0;
+    char* demangled = abi::__cxa_demangle(info.dli_sname, nullptr, nullptr, &status);
+    std::string name = status == 0 && demangled ? demangled : info.dli_sname;
+    free(demangled);
+    size_t paren = name.find('(');
+    if (paren != std::string::npos) name.resize(paren);
+    return name == "firmware_main" ? "main" : name;
+}
+
+NO_INSTRUMENT static void end_iteration() {
+    int64_t duration = clock_us - iteration_start;
+    Stat& main_stat = current[main_fn];
+    main_stat.calls = 1;
+    main_stat.incl = duration;
+    main_stat.self = duration - iteration_children;
+    Stat& main_total = totals[main_fn];
+    main_total.calls = 1;
+    main_total.incl += duration;
+    main_total.self += main_stat.self;
+    main_total.max_incl = std::max(main_total.max_incl, duration);
+    if (duration >= config.min_iter_ms * 1000) {
+        iterations.push_back({iteration_count, iteration_start, clock_us, current});
+    }
+    iteration_count++;
+    current.clear();
+    iteration_children = 0;
+}
+
+static void record_sleep(int64_t us) {
+    if (!profiling || stack.empty()) return;
+    current[stack.back().fn].sleep += us;
+    totals[stack.back().fn].sleep += us;
+}
+
+}
+
+extern "C" {
+
+NO_INSTRUMENT void __cyg_profile_func_enter(void* fn, void* caller) {
+    using namespace sim;
+    if (!profiling) return;
+    if (stack.empty() && !main_fn) {
+        main_fn = fn;
+        iteration_start = clock_us;
+    }
+    stack.push_back({fn, clock_us, 0});
+}
+
+NO_INSTRUMENT void __cyg_profile_func_exit(void* fn, void* caller) {
+    using namespace sim;
+    if (!profiling || stack.empty()) return;
+    Frame frame = stack.back();
+    stack.pop_back();
+    int64_t incl = clock_us - frame.start;
+    for (auto* stats : {&current, &totals}) {
+        Stat& s = (*stats)[frame.fn];
+        s.calls++;
+        s.incl += incl;
+        s.self += incl - frame.child;
+        s.max_incl = std::max(s.max_incl, incl);
+    }
+    if (!stack.empty()) stack.back().child += incl;
+    if (stack.size() == 1) iteration_children += incl;
+}
+
+}
+
+namespace sim {
+
+// Clock and scheduled events.
+
+static std::map<int, std::function<void()>> rise_handlers;
+static bool button_pressed = false;
+static bool in_irq = false;
+static int critical_depth = 0;
+
+static void deliver_interrupts();
+
+static void advance(int64_t us) {
+    clock_us += us;
+    deliver_interrupts();
+    if (!button_pressed && clock_us >= config.press_at_s * 1e6) {
+        auto it = rise_handlers.find(PTC3);
+        if (it != rise_handlers.end()) {
+            button_pressed = true;
+            it->second();
+        }
+    }
+    if (clock_us >= end_us) finish();
+}
+
+int64_t now_us() { return clock_us; }
+
+void sleep_us(int64_t us) {
+    if (profiling && stack.size() == 1 && us <= (int64_t)(config.tick_ms * 1000)) {
+        end_iteration();
+        advance(us);
+        iteration_start = clock_us;
+        return;
+    }
+    record_sleep(us);
+    advance(us);
+}
+
+void busy_us(int64_t us) { advance(us); }
+
+void poll_cost() {
+    if (!in_irq) advance(1);
+}
+
+void critical_section(bool enter) { critical_depth += enter ? 1 : -1; }
+
+void attach_rise(PinName pin, std::function<void()> func) { rise_handlers[pin] = func; }
+
+// I2C bus with BME680 and ENS160 register models.
+
+struct I2CDevice {
+    int address;
+    uint8_t pointer = 0;
+    uint8_t regs[256] = {0};
+};
+
+static I2CDevice bme680{0x76};
+static I2CDevice ens160{0x53};
+
+static void refresh_registers() {
+    Reading r = sample(clock_us);
+    uint32_t temp_adc = (uint32_t)std::max(0.0, (r.temperature * 10 + 700) * 512);
+    uint32_t press_adc = (uint32_t)std::max(0.0, r.pressure * 10 * 16 / 10);
+    uint32_t hum_adc = (uint32_t)std::min(65535.0, std::max(0.0, r.humidity * 10 * 1024 / 10));
+    bme680.regs[0xD0] = 0x61;
+    bme680.regs[0x1F] = press_adc >> 12;
+    bme680.regs[0x20] = press_adc >> 4;
+    bme680.regs[0x21] = (press_adc & 0x0F) << 4;
+    bme680.regs[0x22] = temp_adc >> 12;
+    bme680.regs[0x23] = temp_adc >> 4;
+    bme680.regs[0x24] = (temp_adc & 0x0F) << 4;
+    bme680.regs[0x25] = hum_adc >> 8;
+    bme680.regs[0x26] = hum_adc;
+    uint16_t tvoc = (uint16_t)r.tvoc;
+    uint16_t eco2 = (uint16_t)r.eco2;
+    ens160.regs[0x00] = 0x60;
+    ens160.regs[0x01] = 0x01;
+    ens160.regs[0x20] = 0x03;
+    ens160.regs[0x21] = (uint8_t)r.aqi;
+    ens160.regs[0x22] = tvoc & 0xFF;
+    ens160.regs[0x23] = tvoc >> 8;
+    ens160.regs[0x24] = eco2 & 0xFF;
+    ens160.regs[0x25] = eco2 >> 8;
+}
+
+static I2CDevice* i2c_device(int address) {
+    if ((address >> 1) == bme680.address) return &bme680;
+    if ((address >> 1) == ens160.address) return &ens160;
+    return nullptr;
+}
+
+static void i2c_transfer_cost(int bytes) { advance(10 + (int64_t)(bytes + 1) * 9 * 1000000 / i2c_hz); }
+
+void i2c_frequency(int hz) { i2c_hz = hz; }
+
+int i2c_write(int address, const char* data, int length) {
+    i2c_transfer_cost(length);
+    I2CDevice* dev = i2c_device(address);
+    if (!dev) return 1;
+    if (length > 0) dev->pointer = data[0];
+    for (int i = 1; i < length; i++) dev->regs[(uint8_t)(dev->pointer + i - 1)] = data[i];
+    return 0;
+}
+
+int i2c_read(int address, char* data, int length) {
+    i2c_transfer_cost(length);
+    I2CDevice* dev = i2c_device(address);
+    if (!dev) return 1;
+    refresh_registers();
+    for (int i = 0; i < length; i++) data[i] = dev->regs[(uint8_t)(dev->pointer + i)];
+    return 0;
+}
+
+void lcd_command(int bytes) { advance((int64_t)bytes * 450); }
+
+// UART ports. Bytes arrive at scheduled times into a bounded RX buffer,
+// like BufferedSerial; anything arriving while the buffer is full is lost.
+// UnbufferedSerial ports hold a single byte and, with an RX interrupt
+// attached, hand every byte to the handler as it arrives.
+
+struct Port;
+
+struct SerialDevice {
+    virtual ~SerialDevice() {}
+    virtual void generate(Port& port) {}
+    virtual void receive(Port& port, const uint8_t* data, size_t length) {}
+};
+
+struct Port {
+    int baud;
+    int64_t byte_us;
+    bool blocking = true;
+    size_t capacity = 256;
+    long dropped = 0;
+    int64_t last_scheduled = 0;
+    std::deque<std::pair<int64_t, uint8_t>> pending;
+    std::deque<uint8_t> rx;
+    std::unique_ptr<SerialDevice> device;
+    std::function<void()> isr;
+
+    void schedule(const std::string& bytes, int64_t delay_us) {
+        int64_t t = std::max(clock_us + delay_us, last_scheduled);
+        for (unsigned char c : bytes) {
+            t += byte_us;
+            pending.push_back({t, c});
+        }
+        last_scheduled = t;
+    }
+
+    void sync() {
+        if (device) device->generate(*this);
+        while (!pending.empty() && pending.front().first <= clock_us) {
+            if (rx.size() < capacity) {
+                rx.push_back(pending.front().second);
+            } else if (isr) {
+                break;
+            } else {
+                dropped++;
+            }
+            pending.pop_front();
+        }
+    }
+};
+
+static std::vector<Port>& ports() {
+    static std::vector<Port> all;
+    return all;
+}
+
+static void deliver_interrupts() {
+    if (in_irq || critical_depth > 0) return;
+    in_irq = true;
+    for (auto& port : ports()) {
+        if (!port.isr) continue;
+        if (port.device) port.device->generate(port);
+        while (!port.pending.empty() && port.pending.front().first <= clock_us) {
+            if (!port.rx.empty()) {
+                port.rx.pop_front();
+                port.dropped++;
+            }
+            port.rx.push_back(port.pending.front().second);
+            port.pending.pop_front();
+            port.isr();
+        }
+    }
+    in_irq = false;
+}
+
+// PMS5003 in active mode: one 32-byte frame per interval, or the bursts of
+// a recorded capture (one line of hex bytes per interval, looped).
+
+static std::vector<std::string> pms_capture;
+
+static void load_pms_capture(const std::string& path) {
+    FILE* f = fopen(path.c_str(), "r");
+    if (!f) {
+        fprintf(stderr, "firmware_sim: cannot open capture %s\n", path.c_str());
+        exit(2);
+    }
+    char line[1024];
+    while (fgets(line, sizeof(line), f)) {
+        char* comment = strchr(line, '#');
+        if (comment) *comment = '\0';
+        std::string burst;
+        for (char* tok = strtok(line, " \t\r\n"); tok; tok = strtok(nullptr, " \t\r\n")) {
+            burst += (char)strtol(tok, nullptr, 16);
+        }
+        if (!burst.empty()) pms_capture.push_back(burst);
+    }
+    fclose(f);
+    if (pms_capture.empty()) {
+        fprintf(stderr, "firmware_sim: capture %s has no bytes\n", path.c_str());
+        exit(2);
+    }
+}
+
+struct PMS5003 : SerialDevice {
+    int64_t interval_us = 1000000;
+    int64_t next_frame_us = 250000;
+    size_t next_burst = 0;
+
+    void generate(Port& port) override {
+        while (next_frame_us <= clock_us) {
+            if (!pms_capture.empty()) {
+                port.schedule(pms_capture[next_burst++ % pms_capture.size()], next_frame_us - clock_us);
+                next_frame_us += interval_us;
+                continue;
+            }
+            Reading r = sample(next_frame_us);
+            uint16_t values[] = {
+                (uint16_t)r.pm1_0, (uint16_t)r.pm2_5, (uint16_t)r.pm10,
+                (uint16_t)r.pm1_0, (uint16_t)r.pm2_5, (uint16_t)r.pm10,
+                (uint16_t)r.nc0_3, (uint16_t)r.nc0_5, (uint16_t)r.nc1_0,
+                (uint16_t)r.nc2_5, (uint16_t)r.nc5_0, (uint16_t)r.nc10, 0,
+            };
+            std::string frame = {0x42, 0x4D, 0x00, 0x1C};
+            for (uint16_t v : values) {
+                frame += (char)(v >> 8);
+                frame += (char)(v & 0xFF);
+            }
+            uint16_t checksum = 0;
+            for (unsigned char c : frame) checksum += c;
+            frame += (char)(checksum >> 8);
+            frame += (char)(checksum & 0xFF);
+            port.schedule(frame, next_frame_us - clock_us);
+            next_frame_us += interval_us;
+        }
+    }
+};
+
+// ESP8266 AT firmware: echoes commands, answers them after realistic delays
+// and forwards TCP payloads to a local HTTP server (or a canned responder).
+
+struct ESP8266 : SerialDevice {
+    std::string line;
+    size_t send_remaining = 0;
+    std::string payload;
+    bool connected = false;
+    int fd = -1;
+    int64_t last_activity_us = 0;
+
+    int64_t latency_us() const { return (int64_t)(config.net_latency_ms * 1000); }
+
+    static bool outage() {
+        double t = clock_us / 1e6;
+        return t >= config.outage_from_s && t < config.outage_to_s;
+    }
+
+    void reply(Port& port, const std::string& text, int64_t delay_us) { port.schedule(text, delay_us); }
+
+    void generate(Port& port) override {
+        if (!connected || send_remaining > 0) return;
+        bool peer_closed;
+        if (outage()) {
+            peer_closed = true;
+        } else if (fd >= 0) {
+            char c;
+            ssize_t n = recv(fd, &c, 1, MSG_PEEK | MSG_DONTWAIT);
+            peer_closed = n == 0 || (n < 0 && errno != EAGAIN && errno != EWOULDBLOCK);
+        } else {
+            peer_closed = clock_us - last_activity_us > (int64_t)(config.keepalive_s * 1e6);
+        }
+        if (peer_closed) {
+            close_socket();
+            reply(port, "CLOSED\r\n", 0);
+        }
+    }
+
+    void receive(Port& port, const uint8_t* data, size_t length) override {
+        for (size_t i = 0; i < length; i++) {
+            char c = (char)data[i];
+            if (send_remaining > 0) {
+                payload += c;
+                if (--send_remaining == 0) deliver(port);
+                continue;
+            }
+            line += c;
+            if (line.size() >= 2 && line.compare(line.size() - 2, 2, "\r\n") == 0) {
+                line.resize(line.size() - 2);
+                command(port, line);
+                line.clear();
+            }
+        }
+    }
+
+    void command(Port& port, const std::string& cmd) {
+        reply(port, cmd + "\r\r\n", 0);
+        if (cmd == "AT" || cmd == "AT+CWMODE=1" || cmd == "ATE0" || cmd == "ATE1") {
+            reply(port, "\r\nOK\r\n", 1000);
+        } else if (cmd == "AT+RST") {
+            close_socket();
+            reply(port, "\r\nOK\r\n", 1000);
+            reply(port, "\r\nready\r\n", 600000);
+        } else if (cmd.rfind("AT+CWJAP=", 0) == 0) {
+            reply(port, "WIFI CONNECTED\r\n", 2500000);
+            reply(port, "WIFI GOT IP\r\n\r\nOK\r\n", 1000000);
+        } else if (cmd.rfind("AT+CIPSTART=", 0) == 0) {
+            if (connected) {
+                reply(port, "ALREADY CONNECTED\r\n\r\nERROR\r\n", 1000);
+            } else if (!outage() && open_socket()) {
+                connected = true;
+                last_activity_us = clock_us;
+                reply(port, "CONNECT\r\n\r\nOK\r\n", latency_us() + 20000);
+            } else {
+                reply(port, "ERROR\r\nCLOSED\r\n", latency_us() + 20000);
+            }
+        } else if (cmd.rfind("AT+CIPSEND=", 0) == 0) {
+            if (!connected) {
+                reply(port, "link is not valid\r\n\r\nERROR\r\n", 1000);
+            } else {
+                send_remaining = (size_t)atoi(cmd.c_str() + 11);
+                payload.clear();
+                reply(port, "\r\nOK\r\n> ", 1000);
+            }
+        } else if (cmd == "AT+CIPCLOSE") {
+            if (connected) {
+                close_socket();
+                reply(port, "CLOSED\r\n\r\nOK\r\n", 5000);
+            } else {
+                reply(port, "\r\nERROR\r\n", 1000);
+            }
+        } else {
+            reply(port, "\r\nERROR\r\n", 1000);
+        }
+    }
+
+    bool open_socket() {
+        if (config.http == "canned") return true;
+        std::string host = "127.0.0.1", service = "8000";
+        size_t colon = config.http.rfind(':');
+        if (colon != std::string::npos) {
+            host = config.http.substr(0, colon);
+            service = config.http.substr(colon + 1);
+        }
+        addrinfo hints = {}, *res = nullptr;
+        hints.ai_socktype = SOCK_STREAM;
+        if (getaddrinfo(host.c_str(), service.c_str(), &hints, &res) != 0) return false;
+        fd = socket(res->ai_family, res->ai_socktype, res->ai_protocol);
+        bool ok = fd >= 0 && connect(fd, res->ai_addr, res->ai_addrlen) == 0;
+        freeaddrinfo(res);
+        if (!ok) close_socket();
+        return ok;
+    }
+
+    void close_socket() {
+        if (fd >= 0) close(fd);
+        fd = -1;
+        connected = false;
+    }
+
+    static bool wants_close(const std::string& request) {
+        std::string lower = request;
+        std::transform(lower.begin(), lower.end(), lower.begin(), ::tolower);
+        return lower.find("connection: close") != std::string::npos;
+    }
+
+    static bool response_complete(const std::string& response) {
+        size_t header_end = response.find("\r\n\r\n");
+        if (header_end == std::string::npos) return false;
+        std::string lower = response.substr(0, header_end);
+        std::transform(lower.begin(), lower.end(), lower.begin(), ::tolower);
+        size_t cl = lower.find("content-length:");
+        if (cl == std::string::npos) return false;
+        return response.size() >= header_end + 4 + (size_t)atol(lower.c_str() + cl + 15);
+    }
+
+    std::string canned(const std::string& request, bool& closed) {
+        std::string body;
+        if (request.find("/api/predict-fire") != std::string::npos) {
+            body = "{\"fire_alarm\":0,\"is_fire_detected\":false,\"probability\":0.03,"
+                   "\"message\":\"No fire detected\"}";
+        } else {
+            body = "{\"status\":0,\"is_unsafe\":false,\"probability\":0.02,"
+                   "\"message\":\"Air quality is safe\"}";
+        }
+        closed = wants_close(request);
+        return "HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: " +
+               std::to_string(body.size()) + (closed ? "\r\nconnection: close" : "") + "\r\n\r\n" + body;
+    }
+
+    std::string forward(const std::string& request, bool& closed, int64_t& elapsed_us) {
+        auto started = std::chrono::steady_clock::now();
+        std::string response;
+        closed = false;
+        if (send(fd, request.data(), request.size(), MSG_NOSIGNAL) < 0) {
+            closed = true;
+            return response;
+        }
+        char buf[4096];
+        pollfd p = {fd, POLLIN, 0};
+        while (!response_complete(response) && poll(&p, 1, 5000) > 0) {
+            ssize_t n = recv(fd, buf, sizeof(buf), 0);
+            if (n <= 0) {
+                closed = true;
+                break;
+            }
+            response.append(buf, n);
+        }
+        elapsed_us = std::chrono::duration_cast<std::chrono::microseconds>(
+            std::chrono::steady_clock::now() - started).count();
+        return response;
+    }
+
+    void deliver(Port& port) {
+        last_activity_us = clock_us;
+        reply(port, "\r\nRecv " + std::to_string(payload.size()) + " bytes\r\n\r\nSEND OK\r\n", 2000);
+        bool closed = false;
+        int64_t elapsed_us = 0;
+        std::string response = config.http == "canned" ? canned(payload, closed) : forward(payload, closed, elapsed_us);
+        int64_t delay = latency_us() + elapsed_us;
+        last_activity_us = clock_us + delay;
+        for (size_t offset = 0; offset < response.size(); offset += 1460) {
+            std::string chunk = response.substr(offset, 1460);
+            reply(port, "\r\n+IPD," + std::to_string(chunk.size()) + ":" + chunk, delay);
+            delay = 0;
+        }
+        if (closed) {
+            close_socket();
+            reply(port, "CLOSED\r\n", delay);
+        }
+    }
+};
+
+int open_serial(PinName tx, int baud, bool buffered) {
+    Port port;
+    port.baud = baud;
+    port.capacity = buffered ? 256 : 1;
+    port.byte_us = 10 * 1000000 / baud;
+    if (tx == D1) port.device.reset(new PMS5003());
+    if (tx == PTD3) port.device.reset(new ESP8266());
+    ports().push_back(std::move(port));
+    return (int)ports().size() - 1;
+}
+
+bool serial_readable(int index) {
+    poll_cost();
+    Port& port = ports()[index];
+    port.sync();
+    return !port.rx.empty();
+}
+
+ssize_t serial_read(int index, void* buffer, size_t length) {
+    Port& port = ports()[index];
+    port.sync();
+    while (port.rx.empty()) {
+        if (!port.blocking) return -EAGAIN;
+        advance(std::max<int64_t>(port.byte_us, 1));
+        port.sync();
+    }
+    size_t n = std::min(length, port.rx.size());
+    for (size_t i = 0; i < n; i++) {
+        ((uint8_t*)buffer)[i] = port.rx.front();
+        port.rx.pop_front();
+    }
+    return (ssize_t)n;
+}
+
+ssize_t serial_write(int index, const void* buffer, size_t length) {
+    Port& port = ports()[index];
+    if (length > port.capacity) advance((int64_t)(length - port.capacity) * port.byte_us);
+    if (port.device) port.device->receive(port, (const uint8_t*)buffer, length);
+    return (ssize_t)length;
+}
+
+void serial_set_blocking(int index, bool blocking) { ports()[index].blocking = blocking; }
+
+void serial_attach(int index, std::function<void()> isr) { ports()[index].isr = isr; }
+
+// Report.
+
+static void print_stats_json(FILE* f, const std::map<void*, Stat>& stats) {
+    fprintf(f, "{");
+    bool first = true;
+    for (auto& kv : stats) {
+        fprintf(f, "%s\"%s\": {\"calls\": %ld, \"incl_ms\": %.3f, \"self_ms\": %.3f, \"sleep_ms\": %.3f, \"max_incl_ms\": %.3f}",
+                first ? "" : ", ", function_name(kv.first).c_str(), kv.second.calls, kv.second.incl / 1e3,
+                kv.second.self / 1e3, kv.second.sleep / 1e3, kv.second.max_incl / 1e3);
+        first = false;
+    }
+    fprintf(f, "}");
+}
+
+static void write_json(const std::string& path) {
+    FILE* f = fopen(path.c_str(), "w");
+    if (!f) {
+        fprintf(stderr, "firmware_sim: cannot write %s\n", path.c_str());
+        return;
+    }
+    fprintf(f, "{\n  \"simulated_s\": %.3f,\n  \"loop_iterations\": %ld,\n  \"tick_ms\": %.1f,\n  \"iterations\": [\n",
+            clock_us / 1e6, iteration_count, config.tick_ms);
+    for (size_t i = 0; i < iterations.size(); i++) {
+        const Iteration& it = iterations[i];
+        fprintf(f, "    {\"index\": %ld, \"start_s\": %.3f, \"duration_ms\": %.3f, \"functions\": ", it.index,
+                it.start / 1e6, (it.end - it.start) / 1e3);
+        print_stats_json(f, it.stats);
+        fprintf(f, "}%s\n", i + 1 < iterations.size() ? "," : "");
+    }
+    fprintf(f, "  ],\n  \"totals\": ");
+    print_stats_json(f, totals);
+    long dropped = 0;
+    for (auto& port : ports()) dropped += port.dropped;
+    fprintf(f, ",\n  \"uart_rx_dropped\": %ld\n}\n", dropped);
+    fclose(f);
+}
+
+static std::vector<std::pair<void*, Stat>> by_self(const std::map<void*, Stat>& stats) {
+    std::vector<std::pair<void*, Stat>> sorted(stats.begin(), stats.end());
+    std::sort(sorted.begin(), sorted.end(), [](auto& a, auto& b) { return a.second.self > b.second.self; });
+    return sorted;
+}
+
+static void print_report() {
+    fprintf(stderr, "\nfirmware_sim: %.1f s simulated, %ld loop iterations, %zu took >= %.1f ms\n",
+            clock_us / 1e6, iteration_count, iterations.size(), config.min_iter_ms);
+    fprintf(stderr, "%6s %9s %10s  %s\n", "iter", "start_s", "busy_ms", "self time by function (ms, sleep in brackets)");
+    for (const Iteration& it : iterations) {
+        fprintf(stderr, "%6ld %9.3f %10.1f ", it.index, it.start / 1e6, (it.end - it.start) / 1e3);
+        int shown = 0;
+        for (auto& kv : by_self(it.stats)) {
+            if (shown++ == 6 || kv.second.self < 100) break;
+            fprintf(stderr, " %s %.1f", function_name(kv.first).c_str(), kv.second.self / 1e3);
+            if (kv.second.sleep) fprintf(stderr, " [%.1f]", kv.second.sleep / 1e3);
+        }
+        fprintf(stderr, "\n");
+    }
+    fprintf(stderr, "\n%-28s %7s %12s %12s %12s %12s\n", "function", "calls", "incl_ms", "self_ms", "sleep_ms", "max_incl_ms");
+    for (auto& kv : by_self(totals)) {
+        fprintf(stderr, "%-28s %7ld %12.1f %12.1f %12.1f %12.1f\n", function_name(kv.first).c_str(), kv.second.calls,
+                kv.second.incl / 1e3, kv.second.self / 1e3, kv.second.sleep / 1e3, kv.second.max_incl / 1e3);
+    }
+    for (size_t i = 0; i < ports().size(); i++) {
+        long dropped = ports()[i].dropped;
+        if (dropped) fprintf(stderr, "uart %zu: %ld RX bytes dropped on overflow\n", i, dropped);
+    }
+}
+
+static void finish() {
+    profiling = false;
+    fflush(stdout);
+    if (config.report) print_report();
+    if (!config.json.empty()) write_json(config.json);
+    // --expect reads 32-bit unsigned firmware globals, exported by -rdynamic.
+    int status = 0;
+    for (auto& expected : config.expect) {
+        void* symbol = dlsym(RTLD_DEFAULT, expected.first.c_str());
+        if (!symbol) {
+            fprintf(stderr, "check %s: symbol not found\n", expected.first.c_str());
+            status = 1;
+            continue;
+        }
+        unsigned long value = *(volatile uint32_t*)symbol;
+        fprintf(stderr, "check %s == %lu: %s (got %lu)\n", expected.first.c_str(), expected.second,
+                value == expected.second ? "ok" : "FAILED", value);
+        if (value != expected.second) status = 1;
+    }
+    fflush(stderr);
+    _exit(status);
+}
+
+}
+
+static void usage() {
+    fprintf(stderr,
+            "usage: firmware_sim [--duration S] [--press-at S] [--scenario FILE] [--http canned|HOST:PORT]\n"
+            "                    [--latency-ms MS] [--keepalive-s S] [--outage A:B]\n"
+            "                    [--pms-capture FILE] [--tick-ms MS] [--min-iter-ms MS] [--json FILE] [--quiet]\n"
+            "                    [--expect SYMBOL=VALUE ...] [--no-report]\n");
+    exit(2);
+}
+
+int main(int argc, char** argv) {
+    using sim::config;
+    for (int i = 1; i < argc; i++) {
+        std::string arg = argv[i];
+        auto value = [&]() -> const char* {
+            if (i + 1 >= argc) usage();
+            return argv[++i];
+        };
+        if (arg == "--duration") config.duration_s = atof(value());
+        else if (arg == "--press-at") config.press_at_s = atof(value());
+        else if (arg == "--scenario") config.scenario = value();
+        else if (arg == "--http") config.http = value();
+        else if (arg == "--latency-ms") config.net_latency_ms = atof(value());
+        else if (arg == "--keepalive-s") config.keepalive_s = atof(value());
+        else if (arg == "--outage") {
+            if (sscanf(value(), "%lf:%lf", &config.outage_from_s, &config.outage_to_s) != 2) usage();
+        }
+        else if (arg == "--tick-ms") config.tick_ms = atof(value());
+        else if (arg == "--min-iter-ms") config.min_iter_ms = atof(value());
+        else if (arg == "--json") config.json = value();
+        else if (arg == "--pms-capture") config.pms_capture = value();
+        else if (arg == "--expect") {
+            std::string check = value();
+            size_t eq = check.find('=');
+            if (eq == std::string::npos || eq == 0) usage();
+            config.expect.emplace_back(check.substr(0, eq), strtoul(check.c_str() + eq + 1, nullptr, 0));
+        }
+        else if (arg == "--quiet") config.quiet = true;
+        else if (arg == "--no-report") config.report = false;
+        else usage();
+    }
+    if (!config.scenario.empty()) sim::load_scenario(config.scenario);
+    if (!config.pms_capture.empty()) sim::load_pms_capture(config.pms_capture);
+    if (config.quiet && !freopen("/dev/null", "w", stdout)) return 2;
+    sim::end_us = (int64_t)(config.duration_s * 1e6);
+    sim::profiling = true;
+    firmware_main();
+    sim::finish();
+    return 0;
+}
@@ -0,0 +1,41 @@
+#ifndef SIM_SIM_H
+#define SIM_SIM_H
+
+#include <cstddef>
+#include <cstdint>
+#include <functional>
+#include <sys/types.h>
+
+enum PinName {
+    PTE25, PTE24, PTB9, PTC3, PTD3, PTD2, PTC17, PTC16, LED1,
+    D0 = PTC16,
+    D1 = PTC17,
+    NC = -1
+};
+
+namespace sim {
+
+int64_t now_us();
+void sleep_us(int64_t us);
+void busy_us(int64_t us);
+void poll_cost();
+
+void i2c_frequency(int hz);
+int i2c_write(int address, const char* data, int length);
+int i2c_read(int address, char* data, int length);
+
+void attach_rise(PinName pin, std::function<void()> func);
+
+int open_serial(PinName tx, int baud, bool buffered);
+bool serial_readable(int port);
+ssize_t serial_read(int port, void* buffer, size_t length);
+ssize_t serial_write(int port, const void* buffer, size_t length);
+void serial_set_blocking(int port, bool blocking);
+void serial_attach(int port, std::function<void()> isr);
+void critical_section(bool enter);
+
+void lcd_command(int bytes);
+
+}
+
+#endif
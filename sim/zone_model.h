@@ -0,0 +1,17 @@
+// Host stand-in for the generated zone model. Drop the real zone_model.h
+// next to the firmware source to simulate with the trained forest instead.
+#pragma once
+namespace Eloquent {
+    namespace ML {
+        namespace Port {
+            class RandomForest {
+                public:
+                    int predict(float *x) {
+                        if (x[3] > 1000.0f || x[4] > 25.0f || x[5] > 50.0f) return 2;
+                        if (x[3] > 800.0f || x[4] > 12.0f || x[5] > 25.0f) return 1;
+                        return 0;
+                    }
+            };
+        }
+    }
+}
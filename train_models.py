@@ -0,0 +1,474 @@
+"""Train the air quality and fire detection models and export every artifact.
+
+One run fits the scaler and Random Forest for a model and writes a versioned
+directory with:
+
+* the pickles the API loads (``best_model.pkl``/``scaler.pkl`` or
+  ``fire_detection_model.pkl``/``fire_detection_scaler.pkl``),
+* the embedded header the firmware includes (``zone_model.h`` or
+  ``fire_model.h``),
+* ``manifest.json`` with the feature order, dataset hash, parameters,
+  metrics, library versions and artifact hashes,
+* ``sweep.csv`` with accuracy, latency, pickle size and flash footprint for
+  each ``n_estimators``/``max_depth`` pair when ``--sweep-*`` is given.
+
+Example::
+
+    python3 train_models.py air
+    python3 train_models.py fire --data smoke_detection_iot.csv
+    python3 train_models.py air --sweep-estimators 10,25,50,100 --sweep-depth 4,6,8,none
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import accuracy_score, f1_score
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+
+# Firmware input order for FireModel/ZoneModel.predict() in main.py.
+FIRMWARE_INPUTS = ["temperature", "humidity", "tvoc", "eco2", "pm2_5", "pm10"]
+
+# Classes makePredictions() understands: zone Safe/Warning/Hazardous and fire
+# No fire/Possible/Fire!. Each spec maps its dataset labels onto these.
+FIRMWARE_CLASSES = [0, 1, 2]
+
+MODELS = {
+    "air": {
+        "data": "Numerically_Encoded_Air_Quality_Dataset.csv",
+        "features": [
+            "co2", "pm2_5", "pm10", "temperature", "humidity",
+            "co2_category", "pm2_5_category", "pm10_category",
+            "hour", "day_of_week", "is_weekend",
+        ],
+        "target": "status",
+        "model_file": "best_model.pkl",
+        "scaler_file": "scaler.pkl",
+        "header_file": "zone_model.h",
+        # Binary status: unsafe air is reported as Hazardous; Warning is unreachable.
+        "firmware_classes": {0: 0, 1: 2},
+        # Dataset column feeding each firmware input, or None if the dataset lacks it.
+        "firmware_columns": {
+            "temperature": "temperature",
+            "humidity": "humidity",
+            "tvoc": None,
+            "eco2": "co2",
+            "pm2_5": "pm2_5",
+            "pm10": "pm10",
+        },
+    },
+    "fire": {
+        "data": "smoke_detection_iot.csv",
+        "features": [
+            "Temperature[C]", "Humidity[%]", "TVOC[ppb]", "eCO2[ppm]",
+            "Raw H2", "Raw Ethanol", "Pressure[hPa]",
+            "PM1.0", "PM2.5", "NC0.5", "NC1.0", "NC2.5",
+        ],
+        "target": "Fire Alarm",
+        "model_file": "fire_detection_model.pkl",
+        "scaler_file": "fire_detection_scaler.pkl",
+        "header_file": "fire_model.h",
+        # Binary Fire Alarm: an alarm is reported as Fire!; Possible is unreachable.
+        "firmware_classes": {0: 0, 1: 2},
+        "firmware_columns": {
+            "temperature": "Temperature[C]",
+            "humidity": "Humidity[%]",
+            "tvoc": "TVOC[ppb]",
+            "eco2": "eCO2[ppm]",
+            "pm2_5": "PM2.5",
+            "pm10": None,
+        },
+    },
+}
+
+# Rough Cortex-M4F code size per generated node (load, compare, branch, literal
+# for a split; vote increment for a leaf). Used when arm-none-eabi-gcc is absent.
+FLASH_BYTES_PER_SPLIT = 20
+FLASH_BYTES_PER_LEAF = 8
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare_frame(spec, df, source, require_target=True):
+    """Derive the time features and check every model column (and the target, unless scoring) is present."""
+    if "hour" in spec["features"]:
+        times = pd.to_datetime(df["time"])
+        df["hour"] = times.dt.hour
+        df["day_of_week"] = times.dt.dayofweek
+        df["is_weekend"] = (times.dt.dayofweek >= 5).astype(int)
+    required = spec["features"] + ([spec["target"]] if require_target else [])
+    missing = [c for c in required if c not in df.columns]
+    if missing:
+        raise SystemExit("%s is missing columns: %s" % (source, ", ".join(missing)))
+    return df
+
+
+def load_dataset(spec, path):
+    return prepare_frame(spec, pd.read_csv(path), path)
+
+
+def split_dataset(spec, df, train_size, random_state):
+    """Stratified split into training and held-out rows, keeping the firmware columns."""
+    columns = spec["features"] + [c for c in spec["firmware_columns"].values()
+                                  if c is not None and c not in spec["features"]]
+    return train_test_split(df[columns], df[spec["target"]], train_size=train_size,
+                            random_state=random_state, stratify=df[spec["target"]])
+
+
+def fit_forest(X, y, n_estimators, max_depth, args):
+    model = RandomForestClassifier(
+        n_estimators=n_estimators,
+        max_depth=max_depth,
+        class_weight=args.class_weight,
+        random_state=args.random_state,
+    )
+    return model.fit(X, y)
+
+
+def format_threshold(value):
+    text = "%.9g" % value
+    if "." not in text and "e" not in text:
+        text += ".0"
+    return text + "f"
+
+
+def tree_code(tree, inputs, slots, node, indent):
+    pad = "    " * indent
+    if tree.children_left[node] == -1:
+        return "%svotes[%d] += 1;\n" % (pad, slots[int(np.argmax(tree.value[node][0]))])
+    code = "%sif (x[%d] <= %s) {\n" % (pad, inputs[tree.feature[node]], format_threshold(tree.threshold[node]))
+    code += tree_code(tree, inputs, slots, tree.children_left[node], indent + 1)
+    code += "%s}\n%selse {\n" % (pad, pad)
+    code += tree_code(tree, inputs, slots, tree.children_right[node], indent + 1)
+    code += "%s}\n" % pad
+    return code
+
+
+def firmware_slots(model, class_map):
+    """Firmware class each of the model's classes votes for."""
+    unmapped = [int(c) for c in model.classes_ if int(c) not in class_map]
+    if unmapped:
+        raise SystemExit("No firmware class for dataset classes: %s" % unmapped)
+    return [class_map[int(c)] for c in model.classes_]
+
+
+def export_header(model, inputs, version, class_map=None):
+    """Render the forest as an Eloquent-compatible RandomForest class.
+
+    ``inputs`` maps each training column to its index in the firmware's
+    feature vector, so inputs the dataset lacks are never read. With
+    ``class_map``, leaves vote for the firmware class their dataset class
+    maps to, so predict() returns the firmware's class numbers. After each
+    predict(), margin() gives the lead of the winning class over the
+    runner-up as a percentage of the trees; the firmware escalates
+    low-margin results to the API.
+    """
+    if class_map is None:
+        slots = list(range(len(model.classes_)))
+        n_classes = len(slots)
+    else:
+        slots = firmware_slots(model, class_map)
+        n_classes = len(FIRMWARE_CLASSES)
+    body = ""
+    for i, estimator in enumerate(model.estimators_):
+        body += "                        // tree #%d\n" % (i + 1)
+        body += tree_code(estimator.tree_, inputs, slots, 0, 6)
+    return (
+        "// Generated by train_models.py (%s). Do not edit.\n"
+        "#pragma once\n"
+        "namespace Eloquent {\n"
+        "    namespace ML {\n"
+        "        namespace Port {\n"
+        "            class RandomForest {\n"
+        "                public:\n"
+        "                    int predict(float *x) {\n"
+        "                        int votes[%d] = { 0 };\n"
+        "%s"
+        "                        int classIdx = 0;\n"
+        "                        for (int i = 1; i < %d; i++) {\n"
+        "                            if (votes[i] > votes[classIdx]) classIdx = i;\n"
+        "                        }\n"
+        "                        int runnerUp = 0;\n"
+        "                        for (int i = 0; i < %d; i++) {\n"
+        "                            if (i != classIdx && votes[i] > runnerUp) runnerUp = votes[i];\n"
+        "                        }\n"
+        "                        lastMargin = (votes[classIdx] - runnerUp) * 100 / %d;\n"
+        "                        return classIdx;\n"
+        "                    }\n"
+        "                    int margin() {\n"
+        "                        return lastMargin;\n"
+        "                    }\n"
+        "                private:\n"
+        "                    int lastMargin = 100;\n"
+        "            };\n"
+        "        }\n"
+        "    }\n"
+        "}\n" % (version, n_classes, body, n_classes, n_classes, len(model.estimators_))
+    )
+
+
+def flash_bytes(model, inputs, class_map=None):
+    """Return (bytes, method) for the compiled embedded forest."""
+    compiler = shutil.which("arm-none-eabi-gcc")
+    if compiler:
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "forest.cpp")
+            obj = os.path.join(tmp, "forest.o")
+            with open(source, "w") as f:
+                f.write(export_header(model, inputs, "size probe", class_map))
+                f.write("int forest_predict(float *x) { Eloquent::ML::Port::RandomForest m; return m.predict(x); }\n")
+            subprocess.run([compiler, "-x", "c++", "-Os", "-mcpu=cortex-m4", "-mthumb", "-mfloat-abi=hard",
+                            "-mfpu=fpv4-sp-d16", "-c", source, "-o", obj], check=True)
+            size = subprocess.run(["arm-none-eabi-size", obj], check=True, capture_output=True, text=True)
+            return int(size.stdout.splitlines()[1].split()[0]), "arm-none-eabi-gcc -Os"
+    splits = sum(int((e.tree_.children_left != -1).sum()) for e in model.estimators_)
+    leaves = sum(int((e.tree_.children_left == -1).sum()) for e in model.estimators_)
+    return splits * FLASH_BYTES_PER_SPLIT + leaves * FLASH_BYTES_PER_LEAF, "estimate"
+
+
+def firmware_predict(model, X, class_map=None):
+    """Predict the way the generated header does, in firmware classes when ``class_map`` is given.
+
+    Unlike ``model.predict``, which averages the trees' probabilities, each
+    tree casts one vote for its leaf's majority class, inputs and thresholds
+    are single-precision floats, and a tie goes to the lowest class.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    slots = np.asarray(firmware_slots(model, class_map) if class_map else range(len(model.classes_)))
+    votes = np.zeros((len(X), len(FIRMWARE_CLASSES) if class_map else len(slots)), dtype=int)
+    rows = np.arange(len(X))
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        thresholds = tree.threshold.astype(np.float32)
+        nodes = np.zeros(len(X), dtype=np.intp)
+        active = rows if tree.node_count > 1 else rows[:0]
+        while active.size:
+            current = nodes[active]
+            go_left = X[active, tree.feature[current]] <= thresholds[current]
+            nodes[active] = np.where(go_left, tree.children_left[current], tree.children_right[current])
+            active = active[tree.children_left[nodes[active]] != -1]
+        votes[rows, slots[tree.value[:, 0, :].argmax(axis=1)][nodes]] += 1
+    winners = votes.argmax(axis=1)
+    return winners if class_map else model.classes_[winners]
+
+
+def firmware_accuracy(model, X, y, class_map=None):
+    """Held-out accuracy of the generated header, scored with firmware_predict()."""
+    y = np.asarray(y)
+    if class_map:
+        y = np.array([class_map[int(label)] for label in y])
+    return float(accuracy_score(y, firmware_predict(model, X, class_map)))
+
+
+def pickle_bytes(obj):
+    buffer = io.BytesIO()
+    joblib.dump(obj, buffer)
+    return buffer.getbuffer().nbytes
+
+
+def measure_latency(model, scaler, X, repeats):
+    """Median single-request latency (scale + predict_proba) and batch cost per row, in microseconds."""
+    row = X.iloc[[0]]
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict_proba(scaler.transform(row))
+        samples.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    model.predict_proba(scaler.transform(X))
+    batch = time.perf_counter() - start
+    return float(np.median(samples)) * 1e6, batch / len(X) * 1e6
+
+
+def mean_comparisons(model, X):
+    """Average split comparisons one prediction walks through, across all trees."""
+    indicator, _ = model.decision_path(np.asarray(X, dtype=np.float32))
+    return indicator.sum() / X.shape[0] - len(model.estimators_)
+
+
+def evaluate(model, scaler, X_test, y_test):
+    predicted = model.predict(scaler.transform(X_test))
+    return {
+        "accuracy": float(accuracy_score(y_test, predicted)),
+        "f1": float(f1_score(y_test, predicted, average="macro")),
+    }
+
+
+def run_sweep(args, X_train, X_test, y_train, y_test, scaler, fw_train, fw_test, inputs, class_map):
+    rows = []
+    for n_estimators in args.sweep_estimators:
+        for max_depth in args.sweep_depth:
+            model = fit_forest(scaler.transform(X_train), y_train, n_estimators, max_depth, args)
+            embedded = fit_forest(fw_train, y_train, n_estimators, max_depth, args)
+            single_us, batch_us = measure_latency(model, scaler, X_test, args.latency_repeats)
+            flash, _ = flash_bytes(embedded, inputs, class_map)
+            row = {
+                "n_estimators": n_estimators,
+                "max_depth": "none" if max_depth is None else max_depth,
+                "nodes": sum(e.tree_.node_count for e in model.estimators_),
+                "latency_us": round(single_us, 1),
+                "batch_us_per_row": round(batch_us, 2),
+                "pickle_bytes": pickle_bytes(model),
+                "embedded_accuracy": round(firmware_accuracy(embedded, fw_test, y_test, class_map), 4),
+                "embedded_comparisons": round(float(mean_comparisons(embedded, fw_test)), 1),
+                "flash_bytes": flash,
+            }
+            row.update({k: round(v, 4) for k, v in evaluate(model, scaler, X_test, y_test).items()})
+            rows.append(row)
+            print("  trees=%(n_estimators)s depth=%(max_depth)s acc=%(accuracy).4f "
+                  "latency=%(latency_us).1fus pickle=%(pickle_bytes)dB flash=%(flash_bytes)dB" % row)
+    best = max(r["embedded_accuracy"] for r in rows)
+    smallest = min((r for r in rows if r["embedded_accuracy"] >= best - args.tolerance),
+                   key=lambda r: r["flash_bytes"])
+    print("Smallest embedded forest within %.3f of best accuracy: %d trees, depth %s (%d bytes)"
+          % (args.tolerance, smallest["n_estimators"], smallest["max_depth"], smallest["flash_bytes"]))
+    return rows
+
+
+def parse_depth(text):
+    return None if text.strip().lower() == "none" else int(text)
+
+
+def parse_int_list(text):
+    return [parse_depth(v) for v in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and export the air quality or fire detection model.")
+    parser.add_argument("model", choices=sorted(MODELS))
+    parser.add_argument("--data", help="training CSV (default: the model's dataset)")
+    parser.add_argument("--estimators", type=int, default=100)
+    parser.add_argument("--max-depth", type=parse_depth, default=None,
+                        help="maximum tree depth, or 'none' (default)")
+    parser.add_argument("--train-size", type=float, default=0.8)
+    parser.add_argument("--class-weight", choices=["balanced"], default=None)
+    parser.add_argument("--random-state", type=int, default=42)
+    parser.add_argument("--output-dir", default=os.path.join("model", "versions"))
+    parser.add_argument("--install", action="store_true",
+                        help="also copy the pickles into model/ and the header next to main.py")
+    parser.add_argument("--allow-partial-classes", action="store_true",
+                        help="let --install replace a header that cannot return every firmware class")
+    parser.add_argument("--sweep-estimators", type=parse_int_list)
+    parser.add_argument("--sweep-depth", type=parse_int_list, default=[None])
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="accuracy loss accepted when picking the smallest swept forest")
+    parser.add_argument("--latency-repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    spec = MODELS[args.model]
+    data_path = args.data or spec["data"]
+    if not os.path.exists(data_path):
+        raise SystemExit("Dataset not found: %s (pass --data)" % data_path)
+    df = load_dataset(spec, data_path)
+    features = spec["features"]
+    fw_columns = [c for c in spec["firmware_columns"].values() if c is not None]
+    inputs = [FIRMWARE_INPUTS.index(name) for name, c in spec["firmware_columns"].items() if c is not None]
+
+    X_train, X_test, y_train, y_test = split_dataset(spec, df, args.train_size, args.random_state)
+    fw_train, fw_test = X_train[fw_columns].to_numpy(), X_test[fw_columns].to_numpy()
+    X_train, X_test = X_train[features], X_test[features]
+
+    print("Training %s model on %d rows (%d held out)" % (args.model, len(X_train), len(X_test)))
+    scaler = StandardScaler().fit(X_train)
+    model = fit_forest(scaler.transform(X_train), y_train, args.estimators, args.max_depth, args)
+    # The firmware feeds raw sensor values, so its forest is trained unscaled on its own inputs.
+    embedded = fit_forest(fw_train, y_train, args.estimators, args.max_depth, args)
+    metrics = evaluate(model, scaler, X_test, y_test)
+    metrics["embedded_accuracy"] = firmware_accuracy(embedded, fw_test, y_test, spec["firmware_classes"])
+    metrics["latency_us"], metrics["batch_us_per_row"] = measure_latency(model, scaler, X_test, args.latency_repeats)
+    metrics["embedded_comparisons"] = float(mean_comparisons(embedded, fw_test))
+    metrics["flash_bytes"], flash_method = flash_bytes(embedded, inputs, spec["firmware_classes"])
+
+    unreachable = sorted(set(FIRMWARE_CLASSES) - set(firmware_slots(embedded, spec["firmware_classes"])))
+    if unreachable:
+        print("Warning: %s can never return firmware class(es) %s" % (spec["header_file"], unreachable))
+    dataset_hash = sha256_file(data_path)
+    created = datetime.now(timezone.utc)
+    params = {"n_estimators": args.estimators, "max_depth": args.max_depth, "train_size": args.train_size,
+              "class_weight": args.class_weight, "random_state": args.random_state}
+    params_hash = hashlib.sha256(json.dumps([dataset_hash, features, params], sort_keys=True).encode()).hexdigest()
+    version = "%s-%s-%s" % (args.model, created.strftime("%Y%m%d%H%M%S"), params_hash[:8])
+    out_dir = os.path.join(args.output_dir, version)
+    os.makedirs(out_dir)
+
+    joblib.dump(model, os.path.join(out_dir, spec["model_file"]))
+    joblib.dump(scaler, os.path.join(out_dir, spec["scaler_file"]))
+    with open(os.path.join(out_dir, spec["header_file"]), "w") as f:
+        f.write(export_header(embedded, inputs, version, spec["firmware_classes"]))
+
+    sweep = None
+    if args.sweep_estimators:
+        print("Sweeping forest size:")
+        sweep = run_sweep(args, X_train, X_test, y_train, y_test, scaler, fw_train, fw_test, inputs,
+                          spec["firmware_classes"])
+        with open(os.path.join(out_dir, "sweep.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(sweep[0]))
+            writer.writeheader()
+            writer.writerows(sweep)
+
+    artifacts = {}
+    for name in (spec["model_file"], spec["scaler_file"], spec["header_file"]):
+        path = os.path.join(out_dir, name)
+        artifacts[name] = {"sha256": sha256_file(path), "bytes": os.path.getsize(path)}
+    manifest = {
+        "version": version,
+        "model": args.model,
+        "created": created.isoformat(),
+        "dataset": {"path": data_path, "sha256": dataset_hash, "rows": len(df)},
+        "features": features,
+        "target": spec["target"],
+        "classes": [int(c) for c in model.classes_],
+        "firmware_classes": {str(k): v for k, v in spec["firmware_classes"].items()},
+        "firmware_classes_unreachable": unreachable,
+        "firmware_inputs": FIRMWARE_INPUTS,
+        "firmware_inputs_unused": [n for n, c in spec["firmware_columns"].items() if c is None],
+        "params": params,
+        "metrics": metrics,
+        "flash_method": flash_method,
+        "artifacts": artifacts,
+        "sweep": sweep,
+        "versions": {"python": platform.python_version(), "sklearn": sklearn.__version__,
+                     "numpy": np.__version__, "pandas": pd.__version__, "joblib": joblib.__version__},
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    if args.install:
+        if unreachable and not args.allow_partial_classes:
+            raise SystemExit("Not installing: %s can never return firmware class(es) %s, which makePredictions() "
+                             "relies on. Pass --allow-partial-classes to install anyway." % (spec["header_file"], unreachable))
+        for name in (spec["model_file"], spec["scaler_file"]):
+            shutil.copy(os.path.join(out_dir, name), os.path.join("model", name))
+        shutil.copy(os.path.join(out_dir, spec["header_file"]), spec["header_file"])
+
+    print("Accuracy %.4f, F1 %.4f, embedded accuracy %.4f" % (metrics["accuracy"], metrics["f1"], metrics["embedded_accuracy"]))
+    print("Latency %.1f us/request, %d pickle bytes, %d flash bytes (%s)"
+          % (metrics["latency_us"], artifacts[spec["model_file"]]["bytes"], metrics["flash_bytes"], flash_method))
+    print("Artifacts written to %s" % out_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())